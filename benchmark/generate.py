@@ -0,0 +1,122 @@
+'''Synthetic database generator for the benchmarks
+
+Maps follow the naming schemes of the real data, tmnf campaign maps ('A01'..'E15')
+and tm2020 seasonal campaigns ('Fall 2024 - 07'), so season parsing and the index
+page filters see realistic input.
+'''
+
+import random
+import hashlib
+import datetime
+
+import cpanalytics
+import tm2020parser
+
+TMNF_GROUPS = ("A", "B", "C", "D", "E")
+TMNF_MAPS_PER_GROUP = 15
+TM2020_MAPS_PER_SEASON = 25
+CHECKPOINTS = (3, 12)
+
+def map_names(count, tmnf_share=0.3):
+    '''<count> map names, about <tmnf_share> tmnf and the rest tm2020 (latest season last)'''
+
+    tmnf_count = min(int(count * tmnf_share), len(TMNF_GROUPS) * TMNF_MAPS_PER_GROUP)
+    tmnf = [ "{}{:02d}".format(group, i + 1) for group in TMNF_GROUPS
+                for i in range(TMNF_MAPS_PER_GROUP) ][:tmnf_count]
+
+    tm2020 = []
+    year = datetime.datetime.now().year
+    season_index = len(tm2020parser.SEASON_ORDERING) - 1
+    while len(tm2020) < count - tmnf_count:
+
+        season = tm2020parser.SEASON_ORDERING[season_index]
+        for i in range(TM2020_MAPS_PER_SEASON):
+            tm2020.append("{} {} - {:02d}".format(season, year, i + 1))
+
+        season_index -= 1
+        if season_index < 0:
+            season_index = len(tm2020parser.SEASON_ORDERING) - 1
+            year -= 1
+
+    return [ (name, "tmnf") for name in tmnf ] + \
+                [ (name, "tm2020") for name in tm2020[:count - tmnf_count] ]
+
+def player_names(count):
+    '''Logins of <count> players, some with the ip suffix tmnf logins may carry'''
+    return [ "player{}".format(i) if i % 4 else "player{}/10.0.0.{}".format(i, i % 250)
+                for i in range(count) ]
+
+def _cp_times(race_time, checkpoints, rng):
+
+    weights = [ rng.uniform(0.5, 1.5) for _ in range(checkpoints) ]
+    total = sum(weights)
+
+    cp_times = []
+    elapsed = 0
+    for w in weights[:-1]:
+        elapsed += int(race_time * w / total)
+        cp_times.append(elapsed)
+    cp_times.append(race_time)
+    return cp_times
+
+def generate(server, maps=100, players=50, replays=20000, seed=1, batch_size=5000):
+    '''Fill the (empty) database of <server> with a synthetic but plausible data set'''
+
+    rng = random.Random(seed)
+    db = server.db
+    now = datetime.datetime.now()
+
+    names = map_names(maps)
+    logins = player_names(players)
+
+    map_info = dict()
+    for name, game in names:
+        m = server.Map(map_uid=name, mapname=name, game=game)
+        m.set_campaign()
+        db.session.add(m)
+        map_info.update({ name : (game, rng.randint(25000, 90000), rng.randint(*CHECKPOINTS)) })
+
+    # players differ in skill, so ranks are stable but not identical on every map #
+    skill = dict((login, rng.uniform(1.0, 1.3)) for login in logins)
+
+    rows = []
+    for i in range(replays):
+
+        name, game = names[rng.randrange(len(names))]
+        _, base, checkpoints = map_info[name]
+        login = logins[min(int(rng.paretovariate(1.2)) - 1, len(logins) - 1)]
+
+        race_time = int(base * skill[login] * rng.uniform(1.0, 1.1))
+        if game == "tmnf":
+            race_time -= race_time % 10
+
+        filehash = hashlib.sha512("synthetic-{}-{}".format(seed, i).encode()).hexdigest()
+        rows.append({
+            "filehash" : filehash,
+            "ghost_id" : 1,
+            "race_time" : race_time,
+            "uploader" : login.split("/")[0],
+            "filepath" : "uploads/{}".format(filehash),
+            "upload_dt" : now - datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+            "map_uid" : name,
+            "login" : login,
+            "cp_splits" : cpanalytics.pack_cp_times(_cp_times(race_time, checkpoints, rng)),
+            "login_uid_tm2020" : login if game == "tm2020" else None,
+            "game" : game,
+        })
+
+        if len(rows) >= batch_size:
+            db.session.execute(server.ParsedReplay.__table__.insert(), rows)
+            rows = []
+
+    if rows:
+        db.session.execute(server.ParsedReplay.__table__.insert(), rows)
+
+    # viewers with the different index page filters #
+    for i, login in enumerate(logins[:8]):
+        db.session.add(server.UserSettings(user=login.split("/")[0], show_tm_2020=bool(i & 1),
+                            show_tmnf=bool(i & 2), show_tm_2020_current=bool(i & 4),
+                            notifications_self=True, notifications_all=False))
+
+    db.session.commit()
+    server.rebuild_leaderboard()
@@ -0,0 +1,301 @@
+'''Latency, query count and ingestion benchmarks against a synthetic database
+
+    python -m benchmark.run --maps 200 --players 100 --replays 50000 -o results.json
+    python -m benchmark.run --db-url postgresql://localhost/tm_bench --corpus ~/replays \
+                            --compare results.json
+
+SQLite runs use a fresh temporary database. Other databases must be empty (they are
+filled by the generator) or already contain benchmark data, which is then reused.
+GBX files cannot be synthesized, parsing and upload throughput are measured on the
+replays in --corpus (e.g. a copy of a production uploads/ directory plus original names).
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTH_HEADER = "X-Forwarded-Preferred-Username"
+
+def percentile(values, p):
+
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def summarize(latencies, queries):
+    '''Milliseconds per request and queries per request'''
+
+    ms = [ t * 1000 for t in latencies ]
+    return {
+        "requests" : len(ms),
+        "p50_ms" : percentile(ms, 50),
+        "p90_ms" : percentile(ms, 90),
+        "p99_ms" : percentile(ms, 99),
+        "mean_ms" : sum(ms) / len(ms) if ms else None,
+        "queries" : sum(queries) / len(queries) if queries else None,
+    }
+
+class QueryCounter():
+    '''Count statements executed on an engine'''
+
+    def __init__(self, engine):
+        import sqlalchemy
+        self.count = 0
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+def _workdir():
+    '''Temporary working directory, the server resolves templates & uploads relative to it'''
+
+    path = tempfile.mkdtemp(prefix="tm-bench-")
+    for name in ("templates", "static"):
+        os.symlink(os.path.join(REPO, name), os.path.join(path, name))
+    os.makedirs(os.path.join(path, "uploads"))
+    return path
+
+def datatable_form(order_column=1, start=0, length=10, search=""):
+    return { "draw" : "1", "start" : str(start), "length" : str(length),
+                "search[value]" : search, "search[regex]" : "false",
+                "order[0][column]" : str(order_column), "order[0][dir]" : "asc" }
+
+def build_routes(server):
+    '''(name, method, url, form data) of the benchmarked routes'''
+
+    db = server.db
+    busiest = db.session.query(server.MapLeaderboard.map_uid).order_by(
+                    server.MapLeaderboard.replay_count.desc()).limit(1).scalar()
+
+    return [
+        ("index", "GET", "/", None),
+        ("ranking-overview", "GET", "/ranking-overview", None),
+        ("open-info", "GET", "/open-info", None),
+        ("map-info", "GET", "/map-info?map_uid={}".format(busiest), None),
+        ("data-source", "POST", "/data-source/{}".format(busiest), datatable_form()),
+        ("data-source-deep-page", "POST", "/data-source/{}".format(busiest),
+                datatable_form(start=200)),
+        ("data-source-search", "POST", "/data-source/{}".format(busiest),
+                datatable_form(search="player1")),
+        ("data-source-index", "POST", "/data-source-index", datatable_form(order_column=3)),
+        ("recent-records", "GET", "/recent-records?days=30", None),
+        ("activity", "GET", "/activity?weeks=52", None),
+    ]
+
+def drop_caches(server):
+    '''Forget everything derived from the replays, as an upload to every map would'''
+
+    map_uids = [ map_uid for (map_uid,) in server.db.session.query(server.Map.map_uid) ]
+    server.on_replays_committed(map_uids)
+
+def bench_routes(server, client, counter, viewers, iterations):
+
+    results = dict()
+    for name, method, url, data in build_routes(server):
+
+        results[name] = dict()
+        for mode in ("cold", "warm"):
+
+            latencies = []
+            queries = []
+            for i in range(iterations):
+
+                if mode == "cold":
+                    drop_caches(server)
+
+                headers = { AUTH_HEADER : viewers[i % len(viewers)] }
+                counter.count = 0
+                start = time.perf_counter()
+                if method == "GET":
+                    r = client.get(url, headers=headers)
+                else:
+                    r = client.post(url, headers=headers, data=data)
+                latencies.append(time.perf_counter() - start)
+                queries.append(counter.count)
+
+                if r.status_code != 200:
+                    raise AssertionError("{} returned {}".format(url, r.status_code))
+
+            results[name][mode] = summarize(latencies, queries)
+            print("{:<24} {:<5} p50 {:8.2f}ms p99 {:8.2f}ms {:6.1f} queries".format(name, mode,
+                    results[name][mode]["p50_ms"], results[name][mode]["p99_ms"],
+                    results[name][mode]["queries"]))
+
+    return results
+
+def corpus_files(corpus):
+
+    files = []
+    for root, _, names in os.walk(corpus):
+        files += [ os.path.join(root, n) for n in sorted(names) if n.lower().endswith(".gbx") ]
+    return files
+
+def bench_parse(tm2020parser, files):
+    '''Single process GhostWrapper throughput'''
+
+    failed = 0
+    size = 0
+    start = time.perf_counter()
+    for path in files:
+        size += os.path.getsize(path)
+        _, error = tm2020parser.try_parse_replay_file(path, os.path.basename(path), "benchmark")
+        failed += int(error is not None)
+    seconds = time.perf_counter() - start
+
+    return { "files" : len(files), "failed" : failed, "seconds" : seconds,
+                "files_per_second" : len(files) / seconds, "mb_per_second" : size / seconds / 1e6 }
+
+def bench_upload(client, counter, files, batch_size):
+    '''Throughput of the upload route (parse, store and insert), in batches'''
+
+    latencies = []
+    queries = []
+    start = time.perf_counter()
+    for i in range(0, len(files), batch_size):
+
+        batch = files[i:i + batch_size]
+        data = { "file[]" : [ (open(path, "rb"), os.path.basename(path)) for path in batch ] }
+
+        counter.count = 0
+        t = time.perf_counter()
+        r = client.post("/upload", data=data, headers={ AUTH_HEADER : "benchmark" },
+                            content_type="multipart/form-data")
+        latencies.append(time.perf_counter() - t)
+        queries.append(counter.count)
+
+        for f, _ in data["file[]"]:
+            f.close()
+        if r.status_code != 200:
+            raise AssertionError("upload returned {}".format(r.status_code))
+
+    seconds = time.perf_counter() - start
+    result = summarize(latencies, queries)
+    result.update({ "files" : len(files), "batch_size" : batch_size,
+                        "files_per_second" : len(files) / seconds })
+    return result
+
+def compare(results, baseline_path, threshold):
+    '''Print p50 ratios against a previous run, returns False if any exceeds <threshold>'''
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    ok = True
+    for name, modes in results["routes"].items():
+        for mode, summary in modes.items():
+
+            old = baseline.get("routes", {}).get(name, {}).get(mode)
+            if not old or not old["p50_ms"]:
+                continue
+
+            ratio = summary["p50_ms"] / old["p50_ms"]
+            flag = ""
+            if ratio > threshold:
+                flag = "REGRESSION"
+                ok = False
+
+            print("{:<24} {:<5} p50 {:8.2f}ms -> {:8.2f}ms ({:.2f}x) queries {} -> {} {}".format(
+                    name, mode, old["p50_ms"], summary["p50_ms"], ratio, old["queries"],
+                    summary["queries"], flag))
+    return ok
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO,
+                                            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+
+    parser = argparse.ArgumentParser(description="TM Replay Server benchmarks",
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--db-url",      help="Database to benchmark (default: temporary sqlite)")
+    parser.add_argument("--maps",        type=int, default=100,   help="Synthetic maps")
+    parser.add_argument("--players",     type=int, default=50,    help="Synthetic players")
+    parser.add_argument("--replays",     type=int, default=20000, help="Synthetic replays")
+    parser.add_argument("--seed",        type=int, default=1,     help="Generator seed")
+    parser.add_argument("--iterations",  type=int, default=20,    help="Requests per route")
+    parser.add_argument("--corpus",      help="Directory of .gbx replays for parse/upload")
+    parser.add_argument("--upload-batch", type=int, default=10,   help="Files per upload request")
+    parser.add_argument("-o", "--output", help="Write results as JSON")
+    parser.add_argument("--compare",     help="Previous JSON results to compare against")
+    parser.add_argument("--threshold",   type=float, default=1.25,
+                            help="p50 ratio reported as regression")
+    args = parser.parse_args()
+
+    # paths are relative to the invocation, the benchmark runs in a temporary directory #
+    for name in ("corpus", "output", "compare"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(os.path.expanduser(getattr(args, name))))
+
+    workdir = _workdir()
+    os.environ["DB_URL"] = args.db_url or "sqlite:///" + os.path.join(workdir, "bench.db")
+
+    # the server reads its configuration on import #
+    sys.path.insert(0, REPO)
+    os.chdir(workdir)
+    import server
+    import tm2020parser
+    from benchmark import generate
+
+    with server.app.app_context():
+
+        server.create_app(start_jobs=False)
+        if server.db.session.query(server.ParsedReplay).first():
+            print("Database not empty, benchmarking existing data")
+        else:
+            start = time.perf_counter()
+            generate.generate(server, maps=args.maps, players=args.players,
+                                replays=args.replays, seed=args.seed)
+            print("Generated {} replays in {:.1f}s".format(args.replays,
+                                                            time.perf_counter() - start))
+
+        counter = QueryCounter(server.db.engine)
+        viewers = [ "anonymous" ] + [ login.split("/")[0]
+                        for login in generate.player_names(args.players)[:8] ]
+
+        results = {
+            "meta" : {
+                "dialect" : server.db.engine.dialect.name,
+                "maps" : server.db.session.query(server.Map).count(),
+                "replays" : server.db.session.query(server.ParsedReplay).count(),
+                "iterations" : args.iterations,
+                "generator" : { "maps" : args.maps, "players" : args.players,
+                                    "replays" : args.replays, "seed" : args.seed },
+                "python" : platform.python_version(),
+                "revision" : git_revision(),
+                "date" : datetime.datetime.now().isoformat(),
+            },
+        }
+
+        client = server.app.test_client()
+        results["routes"] = bench_routes(server, client, counter, viewers, args.iterations)
+
+        if args.corpus:
+            files = corpus_files(args.corpus)
+            results["parse"] = bench_parse(tm2020parser, files)
+            print("parse  {files_per_second:.1f} files/s {mb_per_second:.2f} MB/s".format(
+                        **results["parse"]))
+            results["upload"] = bench_upload(client, counter, files, args.upload_batch)
+            print("upload {files_per_second:.1f} files/s".format(**results["upload"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import queue
+import threading
+
+class Subscription():
+    '''Events for one connected client, closed if the client cannot keep up'''
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(queue_size)
+        self.closed = False
+
+    def get(self, timeout):
+        '''Next event or None after <timeout> seconds'''
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class Broadcaster():
+    '''In-process publish/subscribe for server-sent events
+
+    Publishing never blocks: a subscriber whose queue is full is closed and has to
+    reconnect (and reload its state) instead of slowing down the publisher.
+    '''
+
+    def __init__(self, max_subscribers=64, queue_size=64):
+
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+        self.published = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        '''Return a new subscription or None if the subscriber limit is reached'''
+
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                self.rejected += 1
+                return None
+            subscription = Subscription(self.queue_size)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def publish(self, event):
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self.published += 1
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                subscription.closed = True
+                self.unsubscribe(subscription)
+                with self._lock:
+                    self.dropped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers" : len(self._subscribers),
+                "max_subscribers" : self.max_subscribers,
+                "published" : self.published,
+                "rejected" : self.rejected,
+                "dropped" : self.dropped,
+            }
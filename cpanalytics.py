@@ -0,0 +1,99 @@
+import collections
+
+import numpy
+
+# checkpoint times are stored as little endian uint32 milliseconds (as in the replay) #
+CP_DTYPE = numpy.dtype("<u4")
+CP_MAX = int(numpy.iinfo(CP_DTYPE).max)
+
+def pack_cp_times(cp_times):
+    '''Pack a list of (cumulative) checkpoint times into a blob
+
+    Returns None if there are no times or one of them does not fit, such a replay
+    simply has no splits instead of failing the upload.
+    '''
+
+    if not cp_times or any(not 0 <= t <= CP_MAX for t in cp_times):
+        return None
+    return numpy.asarray(cp_times, dtype=CP_DTYPE).tobytes()
+
+def unpack_cp_times(blob):
+    '''Inverse of pack_cp_times, returns an uint32 array'''
+
+    if not blob:
+        return numpy.zeros(0, dtype=CP_DTYPE)
+    return numpy.frombuffer(blob, dtype=CP_DTYPE)
+
+def load_splits(rows):
+    '''Build (logins, race_times, checkpoint matrix) from (login, race_time, blob) rows
+
+    Replays with a checkpoint count different from the most common one (e.g. from
+    an older version of the map) cannot be compared sector by sector and are dropped.
+    '''
+
+    rows = [ r for r in rows if r[2] ]
+    if not rows:
+        return None
+
+    counts = collections.Counter(len(blob) for _, _, blob in rows)
+    size = counts.most_common(1)[0][0]
+    rows = [ r for r in rows if len(r[2]) == size ]
+
+    logins = numpy.array([ login for login, _, _ in rows ], dtype=object)
+    race_times = numpy.array([ race_time for _, race_time, _ in rows ], dtype=numpy.int64)
+
+    blob = b"".join(blob for _, _, blob in rows)
+    cps = numpy.frombuffer(blob, dtype=CP_DTYPE).reshape(len(rows), -1).astype(numpy.int64)
+
+    return logins, race_times, cps
+
+def analyze(logins, race_times, cps):
+    '''Ideal run, sector deltas versus the record and player consistency in one pass'''
+
+    # sector times from cumulative checkpoint times #
+    sectors = numpy.diff(cps, axis=1, prepend=0)
+
+    record = int(numpy.argmin(race_times))
+    best_sectors = sectors.min(axis=0)
+    best_holders = sectors.argmin(axis=0)
+
+    # group replays by player, each player's best run is the first row of its group #
+    players, inverse = numpy.unique(logins.astype(str), return_inverse=True)
+    order = numpy.lexsort((race_times, inverse))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = inverse[order][1:] != inverse[order][:-1]
+    player_best = order[first]
+
+    runs = numpy.bincount(inverse)
+    mean = numpy.bincount(inverse, weights=race_times) / runs
+    mean_sq = numpy.bincount(inverse, weights=race_times.astype(numpy.float64) ** 2) / runs
+    stddev = numpy.sqrt(numpy.maximum(mean_sq - mean ** 2, 0))
+
+    deltas = sectors[player_best] - sectors[record]
+
+    return {
+        "record_login" : logins[record],
+        "record_time" : int(race_times[record]),
+        "ideal_time" : int(best_sectors.sum()),
+        "sectors" : [ {
+                "record" : int(sectors[record, i]),
+                "best" : int(best_sectors[i]),
+                "best_login" : logins[best_holders[i]],
+            } for i in range(sectors.shape[1]) ],
+        "players" : sorted([ {
+                "login" : logins[player_best[p]],
+                "best_time" : int(race_times[player_best[p]]),
+                "runs" : int(runs[p]),
+                "mean_time" : float(mean[p]),
+                "stddev" : float(stddev[p]),
+                "deltas" : [ int(d) for d in deltas[p] ],
+            } for p in range(len(players)) ], key=lambda p: p["best_time"]),
+    }
+
+def analyze_rows(rows):
+    '''Analyze (login, race_time, blob) rows of one map, None if there are no splits'''
+
+    splits = load_splits(rows)
+    if not splits:
+        return None
+    return analyze(*splits)
@@ -0,0 +1,175 @@
+import sys
+import json
+import time
+import datetime
+import threading
+import traceback
+
+import sqlalchemy
+
+STATUSES = ("queued", "running", "done", "failed")
+
+class JobQueue():
+    '''Durable job queue stored in a database table and run by worker threads
+
+    Jobs are added to the current database session by enqueue() and are therefore
+    committed (or rolled back) together with the rows that caused them.
+    '''
+
+    def __init__(self, app, db, model, workers=2, max_attempts=5, backoff=10, poll_interval=5,
+                    retention=7 * 24 * 3600, prune_interval=3600):
+
+        self.app = app
+        self.db = db
+        self.model = model
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+
+        self.handlers = dict()
+        self.pruners = []
+        self._event = threading.Event()
+        self._threads = []
+        self._last_prune = 0
+
+    def handler(self, kind):
+        '''Decorator to register the function executing jobs of <kind>'''
+
+        def register(func):
+            self.handlers.update({ kind : func })
+            return func
+
+        return register
+
+    def pruner(self, func):
+        '''Decorator to register a function deleting other rows older than a cutoff datetime
+
+        Registered functions run in the same transaction whenever finished jobs are pruned.
+        '''
+
+        self.pruners.append(func)
+        return func
+
+    def enqueue(self, kind, run_after=None, **payload):
+        '''Add a job to the current session, it becomes visible with the next commit'''
+
+        if kind not in self.handlers:
+            raise ValueError("No handler for job kind {}".format(kind))
+
+        now = datetime.datetime.now()
+        job = self.model(kind=kind, payload=json.dumps(payload), status="queued", attempts=0,
+                            run_after=run_after or now, created=now, updated=now)
+        self.db.session.add(job)
+        return job
+
+    def wakeup(self):
+        '''Signal the workers that new jobs may have been committed'''
+        self._event.set()
+
+    def start(self):
+        '''Requeue jobs interrupted by a restart and start the worker threads'''
+
+        if self._threads:
+            return
+
+        query = self.db.session.query(self.model).filter(self.model.status == "running")
+        query.update({ "status" : "queued" })
+        self.db.session.commit()
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name="job-worker-{}".format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def status_counts(self):
+        '''Number of jobs per status, including statuses without any jobs'''
+
+        counts = dict.fromkeys(STATUSES, 0)
+        query = self.db.session.query(self.model.status, sqlalchemy.func.count())
+        counts.update(query.group_by(self.model.status).all())
+        return counts
+
+    def prune(self):
+        '''Delete done & failed jobs last updated more than <retention> seconds ago'''
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.retention)
+        query = self.db.session.query(self.model).filter(
+                        self.model.status.in_(("done", "failed")), self.model.updated < cutoff)
+        deleted = query.delete(synchronize_session=False)
+        for func in self.pruners:
+            func(cutoff)
+        self.db.session.commit()
+
+        if deleted:
+            print("Pruned {} finished jobs".format(deleted), file=sys.stderr)
+        return deleted
+
+    def _claim(self):
+        '''Atomically mark the next due job as running and return it'''
+
+        now = datetime.datetime.now()
+        query = self.db.session.query(self.model.id).filter(self.model.status == "queued")
+        query = query.filter(self.model.run_after <= now).order_by(self.model.id)
+
+        for (job_id,) in query.limit(self.workers + 1).all():
+
+            # another worker may have been faster #
+            claim = self.db.session.query(self.model).filter(self.model.id == job_id,
+                                                            self.model.status == "queued")
+            if claim.update({ "status" : "running", "updated" : now }):
+                self.db.session.commit()
+                return self.db.session.get(self.model, job_id)
+
+            self.db.session.rollback()
+
+        return None
+
+    def _execute(self, job):
+
+        try:
+            self.handlers[job.kind](**json.loads(job.payload))
+            job.status = "done"
+            job.last_error = None
+        except Exception as e:
+
+            self.db.session.rollback()
+            traceback.print_exc()
+
+            job.attempts += 1
+            job.last_error = "{}: {}".format(type(e).__name__, e)
+
+            if job.attempts >= self.max_attempts:
+                job.status = "failed"
+                print("Job {} ({}) failed permanently".format(job.id, job.kind), file=sys.stderr)
+            else:
+                delay = self.backoff * 2 ** (job.attempts - 1)
+                job.status = "queued"
+                job.run_after = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+
+        job.updated = datetime.datetime.now()
+        self.db.session.commit()
+
+    def _run(self):
+
+        while True:
+
+            job = None
+            with self.app.app_context():
+                try:
+                    job = self._claim()
+                    if job:
+                        self._execute(job)
+                    elif time.monotonic() - self._last_prune > self.prune_interval:
+                        self._last_prune = time.monotonic()
+                        self.prune()
+                except sqlalchemy.exc.SQLAlchemyError:
+                    traceback.print_exc()
+                    self.db.session.rollback()
+
+            # keep draining while there is work, otherwise sleep until woken #
+            if not job:
+                self._event.wait(self.poll_interval)
+                self._event.clear()
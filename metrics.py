@@ -0,0 +1,201 @@
+import time
+import bisect
+import threading
+import contextlib
+import collections
+
+import sqlalchemy
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_metrics = []
+
+def _format_labels(names, values, extra=None):
+
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+
+    escaped = [ (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for n, v in pairs ]
+    return "{" + ",".join('{}="{}"'.format(n, v) for n, v in escaped) + "}"
+
+class Counter():
+
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(float)
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                yield self.name + _format_labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    '''Value set at scrape time from existing statistics'''
+
+    kind = "gauge"
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram():
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = dict()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[labels] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                                for labels, (counts, total) in self._values.items())
+
+        for labels, (counts, total) in values:
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket" + _format_labels(self.labelnames, labels,
+                                                    ("le", bound)), cumulative
+
+            yield self.name + "_sum" + _format_labels(self.labelnames, labels), total
+            yield self.name + "_count" + _format_labels(self.labelnames, labels), cumulative
+
+def render():
+    '''All metrics in the Prometheus text exposition format'''
+
+    lines = []
+    for metric in _metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.description))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append("{} {}".format(name, value))
+
+    return "\n".join(lines) + "\n"
+
+REQUEST_SECONDS = Histogram("tm_request_seconds", "Request duration",
+                                ("route", "method", "status"))
+REQUEST_QUERIES = Histogram("tm_request_queries", "SQL statements per request", ("route",),
+                                buckets=COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram("tm_request_db_seconds", "Time spent in SQL per request",
+                                ("route",))
+QUERY_BUDGET_EXCEEDED = Counter("tm_query_budget_exceeded_total",
+                                "Requests executing more statements than the query budget",
+                                ("route",))
+QUERIES = Counter("tm_queries_total", "SQL statements by context", ("context",))
+TEMPLATE_SECONDS = Histogram("tm_template_render_seconds", "Template render time",
+                                ("template",))
+GBX_PARSE_SECONDS = Histogram("tm_gbx_parse_seconds", "GBX parse time per replay", ("game",))
+S3_SECONDS = Histogram("tm_s3_seconds", "S3 operation latency", ("operation", "outcome"))
+DISPATCH_SECONDS = Histogram("tm_dispatch_seconds", "Notification dispatch latency",
+                                ("outcome",))
+
+class RequestStats():
+    '''SQL statements of the request running in the current thread'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = collections.Counter()
+
+_local = threading.local()
+
+def begin_request():
+    _local.request = RequestStats()
+
+def end_request():
+    '''Finish the request of the current thread and return its stats (None if none)'''
+
+    stats = getattr(_local, "request", None)
+    _local.request = None
+    return stats
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+
+    stats = getattr(_local, "request", None)
+    if stats is None:
+        QUERIES.inc("background")
+        return
+
+    QUERIES.inc("request")
+    stats.queries += 1
+    stats.db_seconds += seconds
+    stats.statements[statement] += 1
+
+def _handle_error(exception_context):
+
+    # a failed statement never reaches after_cursor_execute, drop its start time #
+    conn = exception_context.connection
+    if conn is None or exception_context.execution_context is None:
+        return
+
+    starts = conn.info.get("query_start")
+    if starts:
+        starts.pop()
+
+def instrument_engine(engine):
+    '''Count and time all statements executed on <engine>'''
+
+    if sqlalchemy.event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", _handle_error)
+
+def before_render_template(sender, template, context, **extra):
+    stack = getattr(_local, "templates", None)
+    if stack is None:
+        stack = _local.templates = []
+    stack.append(time.perf_counter())
+
+def template_rendered(sender, template, context, **extra):
+    start = _local.templates.pop()
+    TEMPLATE_SECONDS.observe(time.perf_counter() - start, template.name or "string")
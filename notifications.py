@@ -1,31 +1,136 @@
 import sys
+import json
+import time
+import argparse
+import threading
+import http.server
+
 import requests
+import requests.adapters
+
+import metrics
+
+# (connect, read) timeout for the dispatcher #
+DISPATCH_TIMEOUT = (3, 10)
+
+# recipients per dispatcher request #
+DISPATCH_BATCH_SIZE = 50
+
+class DispatchError(Exception):
+    '''Failed handoff, the message never contains the URL as it includes the access token'''
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    '''Return the process-wide HTTP session, its connections are reused across dispatches'''
+
+    global _session
+    with _session_lock:
+        if not _session:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+def record_lines(old_replay, new_replay):
+    return [ "Old time:   {}".format(old_replay.get_human_readable_time()),
+             "New time: {}".format(new_replay.get_human_readable_time()) ]
+
+def build_message(records):
+    '''Message for a list of (mapname, old replay, new replay), one digest for several'''
+
+    if len(records) == 1:
+        mapname, old_replay, new_replay = records[0]
+        message = "TM: Record broken on {}\n\n".format(mapname)
+        message += "\n".join(record_lines(old_replay, new_replay)) + "\n"
+        message += "\nby {}".format(new_replay.clean_login())
+        return message
+
+    message = "TM: {} records broken\n".format(len(records))
+    for mapname, old_replay, new_replay in records:
+        message += "\n{} by {}\n".format(mapname, new_replay.clean_login())
+        message += "\n".join(record_lines(old_replay, new_replay)) + "\n"
+
+    return message
+
+def batches(users):
+    users = sorted(users)
+    for i in range(0, len(users), DISPATCH_BATCH_SIZE):
+        yield users[i:i + DISPATCH_BATCH_SIZE]
 
-def send_notification(app, target_user, mapname, old_replay, new_replay):
-    '''Build notification and handoff to dispatcher'''
+def dispatch(app, users, message):
+    '''Handoff one message for a list of users to the dispatcher'''
 
-    url =  app.config["DISPATCH_SERVER"]
+    url = app.config["DISPATCH_SERVER"]
 
     if not url:
         return
 
-    # send to event dispatcher #
-    message = "TM: Record broken on {}\n\n".format(mapname)
-    message += "Old time:   {}\n".format(old_replay.get_human_readable_time())
-    message += "New time: {}\n".format(new_replay.get_human_readable_time())
-    message += "\nby {}".format(new_replay.clean_login())
-
     payload = {
-        "users": [target_user],
+        "users": users,
         "msg" : message,
         "method" : "any"
     }
 
     url_and_token = "/smart-send?dispatch-access-token={}".format(app.config["DISPATCH_TOKEN"])
-    r = requests.post(app.config["DISPATCH_SERVER"] + url_and_token, json=payload)
+    start = time.perf_counter()
+    try:
+        r = get_session().post(url + url_and_token, json=payload, timeout=DISPATCH_TIMEOUT)
+    except requests.RequestException as e:
+        metrics.DISPATCH_SECONDS.observe(time.perf_counter() - start, "error")
+        raise DispatchError("Dispatcher unreachable ({})".format(type(e).__name__)) from None
+    metrics.DISPATCH_SECONDS.observe(time.perf_counter() - start, "ok" if r.ok else "rejected")
 
     if not r.ok:
         msg = "Error handing off notification to dispatch ({} {})".format(r.status_code, r.content)
         print(msg, file=sys.stderr)
+        raise DispatchError("Dispatcher rejected notification ({})".format(r.status_code))
     else:
-        print("Handed off notification for {} to dispatch".format(target_user), file=sys.stderr)
+        print("Handed off notification for {} to dispatch".format(", ".join(users)),
+                file=sys.stderr)
+
+class FakeDispatcher(http.server.ThreadingHTTPServer):
+    '''Local stand-in for the dispatcher, collects the payloads it receives
+
+    Run it with 'python notifications.py' and set DISPATCH_SERVER to its address.
+    '''
+
+    def __init__(self, address=("127.0.0.1", 0), verbose=False):
+
+        self.received = []
+        self.verbose = verbose
+        dispatcher = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                payload = json.loads(body)
+                dispatcher.received.append(payload)
+                if dispatcher.verbose:
+                    print("{} -> {}".format(payload["users"], payload["msg"]))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(address, Handler)
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fake notification dispatcher",
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-i", "--interface", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("-p", "--port", type=int, default=5001, help="Port to listen on")
+    args = parser.parse_args()
+
+    server = FakeDispatcher((args.interface, args.port), verbose=True)
+    print("Fake dispatcher on {} (DISPATCH_SERVER)".format(server.url))
+    server.serve_forever()
@@ -0,0 +1,177 @@
+import os
+import sys
+import tempfile
+import threading
+import collections
+
+class _Flight():
+    '''A fetch in progress, concurrent requests for the same key wait on it'''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+class _CacheWriter():
+    '''Incrementally written cache entry, only visible after commit()'''
+
+    def __init__(self, cache, key, flight):
+        self.cache = cache
+        self.key = key
+        self.flight = flight
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.directory, prefix=".tee-")
+        self.f = os.fdopen(fd, "wb")
+        self.done = False
+
+    def write(self, chunk):
+        self.f.write(chunk)
+
+    def commit(self):
+        self.done = True
+        self.f.close()
+        os.replace(self.tmp_path, self.cache.path(self.key))
+        self.cache.add(self.key)
+        self.cache._land(self.key, self.flight, None)
+
+    def abort(self, error=None):
+        '''Drop the entry, does nothing if it was already committed or aborted'''
+
+        if self.done:
+            return
+        self.done = True
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.cache._land(self.key, self.flight, error or IOError("Cache fill aborted"))
+
+class ReplayCache():
+    '''Size-bounded on-disk LRU cache for replays fetched from remote storage'''
+
+    def __init__(self, directory, max_bytes):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._inflight = dict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        '''Rebuild the LRU order from files left by a previous run (oldest access first)'''
+
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("."):
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            files.append((st.st_atime, name, st.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+        with self._lock:
+            self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key):
+        '''Return the local path for <key> if cached (counted as hit or miss), else None'''
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self.path(key)
+            self.misses += 1
+            return None
+
+    def wait(self, key, timeout):
+        '''Wait for a fill of <key> by another request, return its path or None
+
+        None if nothing is in flight, the fill failed or did not land within <timeout>
+        seconds (e.g. a slow client of the filling request).
+        '''
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            if not flight:
+                return None
+            self.coalesced += 1
+
+        if not flight.event.wait(timeout) or flight.error:
+            return None
+
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self.path(key)
+
+    def tee(self, key):
+        '''Return a writer to fill <key> while streaming it elsewhere
+
+        Returns None if the key is cached or already being fetched by someone else.
+        '''
+
+        with self._lock:
+            if key in self._entries or key in self._inflight:
+                return None
+            flight = _Flight()
+            self._inflight[key] = flight
+
+        return _CacheWriter(self, key, flight)
+
+    def _land(self, key, flight, error):
+        flight.error = error
+        with self._lock:
+            del self._inflight[key]
+        flight.event.set()
+
+    def add(self, key):
+        '''Register a file that was placed at path(key) and evict if necessary'''
+
+        size = os.path.getsize(self.path(key))
+        with self._lock:
+            self._size += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        '''Remove least recently used files until the size bound holds (lock held)'''
+
+        # never evict the most recently used entry #
+        while self._size > self.max_bytes and len(self._entries) > 1:
+
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                print("Cache file {} vanished".format(key), file=sys.stderr)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "coalesced" : self.coalesced,
+                "evictions" : self.evictions,
+                "files" : len(self._entries),
+                "bytes" : self._size,
+                "max_bytes" : self.max_bytes,
+            }
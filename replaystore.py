@@ -0,0 +1,148 @@
+import os
+import time
+import shutil
+import string
+import hashlib
+import tempfile
+
+# prefixes of temporary files & directories inside the store #
+TEMP_PREFIXES = (".upload-", ".reindex-")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def is_filehash(name):
+    '''True if <name> looks like a (hex) replay hash and is safe to use in a path'''
+
+    return bool(name) and len(name) >= 8 and all(c in string.hexdigits for c in name)
+
+def file_hash(path):
+    '''SHA-512 of a stored file, the name it is stored under'''
+
+    f_hash = hashlib.sha512()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            f_hash.update(chunk)
+
+    return f_hash.hexdigest()
+
+class ReplayStore():
+    '''Content-addressed replay files, sharded by hash prefix (uploads/ab/cd/abcd...)
+
+    Replays stored before sharding lie flat in the directory and are still found,
+    relocate() moves them into their shard. Temporary files are created in the top
+    directory (same filesystem) and renamed into place once complete.
+    '''
+
+    def __init__(self, directory, levels=2, width=2):
+        self.directory = directory
+        self.levels = levels
+        self.width = width
+
+    def shard(self, filehash):
+        parts = [ filehash[i * self.width:(i + 1) * self.width] for i in range(self.levels) ]
+        return os.path.join(self.directory, *parts)
+
+    def path(self, filehash):
+        return os.path.join(self.shard(filehash), filehash)
+
+    def legacy_path(self, filehash):
+        return os.path.join(self.directory, filehash)
+
+    def locate(self, filehash):
+        '''Path of a stored replay in either layout, None if it is not on disk'''
+
+        if not is_filehash(filehash):
+            return None
+
+        for path in (self.path(filehash), self.legacy_path(filehash)):
+            if os.path.isfile(path):
+                return path
+
+        return None
+
+    def temp_file(self, prefix=".upload-"):
+        '''Open a temporary file to be committed with commit()'''
+
+        os.makedirs(self.directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix=prefix, delete=False)
+
+    def commit(self, tmp_path, filehash):
+        '''Atomically move a complete temporary file to its final location'''
+
+        # the content must be on disk before the rename makes it visible #
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+
+        path = self.path(filehash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return path
+
+    def relocate(self, filehash):
+        '''Move a replay from the flat layout into its shard, return its new path'''
+
+        legacy = self.legacy_path(filehash)
+        path = self.path(filehash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(legacy, path)
+        return path
+
+    def walk(self):
+        '''Yield (filehash, path) of all stored replays in both layouts'''
+
+        for root, dirs, files in os.walk(self.directory):
+
+            relative = os.path.relpath(root, self.directory)
+            depth = 0 if relative == os.curdir else len(relative.split(os.sep))
+
+            # shards only, skip temporary directories & deeper trees #
+            dirs[:] = [ d for d in dirs if depth < self.levels and len(d) == self.width
+                            and all(c in string.hexdigits for c in d) ]
+
+            if depth not in (0, self.levels):
+                continue
+
+            for name in files:
+                if is_filehash(name):
+                    yield name, os.path.join(root, name)
+
+    def gc(self, max_age=3600):
+        '''Remove temporary files & directories older than <max_age> seconds
+
+        They are left behind by uploads and reindex runs that crashed, only the top
+        directory is scanned.
+        '''
+
+        removed = 0
+        freed = 0
+        cutoff = time.time() - max_age
+
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return removed, freed
+
+        for entry in entries:
+
+            if not entry.name.startswith(TEMP_PREFIXES):
+                continue
+
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > cutoff:
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+                    freed += stat.st_size
+            except FileNotFoundError:
+                continue
+
+            removed += 1
+
+        return removed, freed
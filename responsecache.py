@@ -0,0 +1,148 @@
+import os
+import functools
+import threading
+import importlib
+import collections
+
+import flask
+
+GLOBAL_SCOPE = "*"
+
+class LRUBackend():
+    '''In-process backend, least recently used entries are dropped above max_entries
+
+    A shared backend (e.g. for several server processes) must provide the same
+    get/set/incr/counter methods and can be selected with RESPONSE_CACHE_BACKEND=module:Class.
+    '''
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._counters = dict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def incr(self, key):
+        '''Increment a counter, counters are never evicted'''
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def __len__(self):
+        return len(self._entries)
+
+def backend_from_env():
+    '''Instantiate the backend named in RESPONSE_CACHE_BACKEND or the in-process LRU'''
+
+    name = os.environ.get("RESPONSE_CACHE_BACKEND")
+    if not name:
+        return LRUBackend(int(os.environ.get("RESPONSE_CACHE_ENTRIES") or 2048))
+
+    module, cls = name.split(":")
+    return getattr(importlib.import_module(module), cls)()
+
+class ResponseCache():
+    '''Generation-counter based cache for rendered responses and fragments
+
+    Every entry is stored under the generation of its scope (a map_uid or the
+    global scope) at the time it was computed. Invalidating a scope increments
+    its generation, so old entries are never read again and simply age out.
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend or LRUBackend()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, scope):
+        return self.backend.counter("gen:{}".format(scope))
+
+    def invalidate(self, scopes):
+        '''Invalidate the given scopes and the global scope, which depends on all of them'''
+
+        for scope in set(scopes):
+            self.backend.incr("gen:{}".format(scope))
+        self.backend.incr("gen:{}".format(GLOBAL_SCOPE))
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def fragment(self, key, scope, compute):
+        '''Return the cached value for <key> in <scope> or compute and store it'''
+
+        full_key = repr((key, scope, self.generation(scope)))
+
+        value = self.backend.get(full_key)
+        self._count(value is not None)
+        if value is None:
+            value = compute()
+            self.backend.set(full_key, value)
+
+        return value
+
+    def cached(self, scope=None, vary=None):
+        '''Decorator caching successful responses of a view
+
+        scope(**view_args) returns the scope of the view (default: global),
+        vary() returns additional key parts such as the viewer's settings.
+        '''
+
+        def decorator(view):
+
+            @functools.wraps(view)
+            def wrapper(**view_args):
+
+                request = flask.request
+                key = (request.endpoint, sorted(view_args.items()),
+                        sorted(request.args.items(multi=True)), vary() if vary else None)
+                view_scope = scope(**view_args) if scope else GLOBAL_SCOPE
+
+                full_key = repr((key, view_scope, self.generation(view_scope)))
+                entry = self.backend.get(full_key)
+                self._count(entry is not None)
+
+                if entry is not None:
+                    body, status, content_type = entry
+                    return flask.Response(body, status=status, content_type=content_type)
+
+                response = flask.make_response(view(**view_args))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    entry = (response.get_data(), response.status_code, response.content_type)
+                    self.backend.set(full_key, entry)
+
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hit_rate" : self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,122 @@
+import os
+import time
+import threading
+import contextlib
+
+import boto3
+import botocore.config
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+
+import metrics
+
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+# size the connection pool for the transfer threads of all concurrent requests #
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS") or 32)
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD") or 8 * 1024 * 1024),
+    multipart_chunksize=int(os.getenv("S3_MULTIPART_CHUNKSIZE") or 8 * 1024 * 1024),
+    max_concurrency=int(os.getenv("S3_MAX_CONCURRENCY") or 8),
+    use_threads=True)
+
+_client = None
+_client_lock = threading.Lock()
+
+def s3_enabled():
+    return all([
+        os.getenv("AWS_ACCESS_KEY_ID"),
+        os.getenv("AWS_SECRET_ACCESS_KEY"),
+        S3_BUCKET
+    ])
+
+def get_s3_client():
+    '''Return the process-wide S3 client (boto3 clients are thread-safe)'''
+
+    global _client
+    with _client_lock:
+
+        if _client:
+            return _client
+
+        config = botocore.config.Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    retries={ "max_attempts" : 5, "mode" : "standard" },
+                    s3={ "addressing_style" : os.getenv("S3_ADDRESSING_STYLE") or "auto" })
+
+        kwargs = { "config" : config }
+        if S3_ENDPOINT_URL:
+            kwargs["endpoint_url"] = S3_ENDPOINT_URL
+
+        _client = boto3.client("s3", **kwargs)
+        return _client
+
+class TransferStats():
+    '''Count and latency of S3 operations, grouped by operation name'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = dict()
+
+    def record(self, op, seconds, error=False):
+        with self._lock:
+            s = self._ops.setdefault(op, { "count" : 0, "errors" : 0, "seconds_total" : 0.0,
+                                                "seconds_max" : 0.0 })
+            s["count"] += 1
+            s["errors"] += int(error)
+            s["seconds_total"] += seconds
+            s["seconds_max"] = max(s["seconds_max"], seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return dict((op, dict(s)) for op, s in self._ops.items())
+
+stats = TransferStats()
+
+@contextlib.contextmanager
+def timed(op):
+    '''Record the duration of an S3 operation in the transfer stats'''
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stats.record(op, time.perf_counter() - start, error=True)
+        metrics.S3_SECONDS.observe(time.perf_counter() - start, op, "error")
+        raise
+    stats.record(op, time.perf_counter() - start)
+    metrics.S3_SECONDS.observe(time.perf_counter() - start, op, "ok")
+
+def upload_file(local_path, key):
+    with timed("upload"):
+        get_s3_client().upload_file(local_path, S3_BUCKET, key, Config=TRANSFER_CONFIG)
+    return key
+
+def download_file(key, local_path):
+    with timed("download"):
+        get_s3_client().download_file(S3_BUCKET, key, local_path, Config=TRANSFER_CONFIG)
+
+def get_object(key, byte_range=None):
+    '''Open an object for streaming, the body is read by the caller'''
+
+    kwargs = { "Bucket" : S3_BUCKET, "Key" : key }
+    if byte_range:
+        kwargs["Range"] = byte_range
+
+    with timed("get_object"):
+        return get_s3_client().get_object(**kwargs)
+
+def head_object(key):
+    '''Size of an object, None if it does not exist'''
+
+    try:
+        with timed("head_object"):
+            response = get_s3_client().head_object(Bucket=S3_BUCKET, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+    return response["ContentLength"]
@@ -1,6 +1,15 @@
 #!/usr/bin/python3
 import hashlib
+import time
 import os
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+import collections
+import itertools
 import flask
 import werkzeug
 import argparse
@@ -12,9 +21,20 @@ from pygbx import Gbx, GbxType
 import pygbx
 import tm2020parser
 import notifications
+import jobqueue
+import s3storage
+import replaycache
+import replaystore
+import responsecache
+import cpanalytics
+import metrics
+import broadcast
 
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, Boolean, or_, and_, asc, desc
+import botocore.exceptions
+from sqlalchemy import Column, Index, Integer, String, Boolean, DateTime, LargeBinary
+from sqlalchemy import or_, and_, asc, desc
+from sqlalchemy.orm import relationship
 from flask_sqlalchemy import SQLAlchemy
 
 import os
@@ -25,86 +45,138 @@ app = flask.Flask("TM Friends Replay Server")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DB_URL") or "sqlite:///sqlite.db"
 app.config["AUTH_HEADER"] = os.environ.get("AUTH_HEADER") or "X-Forwarded-Preferred-Username"
+app.config["PARSE_WORKERS"] = int(os.environ.get("PARSE_WORKERS") or os.cpu_count() or 1)
+app.config["QUERY_BUDGET"] = int(os.environ.get("QUERY_BUDGET") or 50)
+app.config["NOTIFY_WINDOW"] = int(os.environ.get("NOTIFY_WINDOW") or 60)
+app.config["SSE_MAX_SUBSCRIBERS"] = int(os.environ.get("SSE_MAX_SUBSCRIBERS") or 64)
+app.config["SSE_HEARTBEAT"] = int(os.environ.get("SSE_HEARTBEAT") or 15)
+app.config["SSE_MAX_SECONDS"] = int(os.environ.get("SSE_MAX_SECONDS") or 300)
 
-S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
 db = SQLAlchemy(app)
+response_cache = responsecache.ResponseCache(responsecache.backend_from_env())
+live_updates = broadcast.Broadcaster(app.config["SSE_MAX_SUBSCRIBERS"])
+replay_store = replaystore.ReplayStore(os.environ.get("UPLOAD_DIR") or "uploads")
 
-SEASON_ORDERING = ["Winter", "Spring", "Summer", "Fall"]
-def filter_for_current_season(maps):
+@app.before_request
+def begin_request_metrics():
+    metrics.begin_request()
 
-    maps = list(maps)
+@app.after_request
+def record_request_metrics(response):
 
-    year = str(datetime.datetime.now().year)
+    stats = metrics.end_request()
+    if not stats:
+        return response
 
-    season = 0
-    for m in maps:
+    route = flask.request.url_rule.rule if flask.request.url_rule else "unmatched"
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - stats.start, route,
+                                        flask.request.method, response.status_code)
+    metrics.REQUEST_QUERIES.observe(stats.queries, route)
+    metrics.REQUEST_DB_SECONDS.observe(stats.db_seconds, route)
 
-        if year not in m.mapname:
-            continue
-        else:
-            for i, season_name in enumerate(SEASON_ORDERING):
-                if season_name in m.mapname and i > season:
-                    season = i
+    # repeated statements are usually lazy loads in a loop #
+    if stats.queries > app.config["QUERY_BUDGET"]:
+        metrics.QUERY_BUDGET_EXCEEDED.inc(route)
+        print("Query budget exceeded: {} {} ran {} statements ({:.1f}ms)".format(
+                    flask.request.method, flask.request.path, stats.queries,
+                    stats.db_seconds * 1000), file=sys.stderr)
+        for statement, count in stats.statements.most_common(3):
+            print("  {}x {}".format(count, " ".join(statement.split())[:500]), file=sys.stderr)
+
+    return response
 
-    filter_func = lambda m: SEASON_ORDERING[season] in m.mapname and year in m.mapname
-    maps_season = list(filter(filter_func, maps))
-    return maps_season
+flask.before_render_template.connect(metrics.before_render_template, app)
+flask.template_rendered.connect(metrics.template_rendered, app)
+
+# tmnf campaign groups and tm2020 seasons shown on the index page #
+LISTED_PREFIXES = ("A", "B", "C", "D", "E", "Fall", "Winter", "Spring", "Summer")
 
 class Map(db.Model):
 
     __tablename__ = "maps"
+    __table_args__ = (
+        Index("ix_maps_season_order", "season_order"),
+        Index("ix_maps_year_season_order", "year", "season_order"),
+    )
 
     map_uid = Column(String, primary_key=True)
     mapname = Column(String)
     game    = Column(String)
 
-    def get_best_replay(self):
-
-        q = db.session.query(ParsedReplay).filter(ParsedReplay.map_uid == self.map_uid)
-        r = q.order_by(asc(ParsedReplay.race_time)).first()
-        return r
+    # parsed from the mapname on ingestion, see set_campaign() #
+    listed       = Column(Boolean)
+    season       = Column(String)
+    year         = Column(Integer)
+    season_order = Column(Integer)
+    campaign_pos = Column(Integer)
 
-    def get_best_replay_for_player(self, player):
+    leaderboard = relationship("MapLeaderboard", uselist=False, viewonly=True, lazy="joined",
+                        primaryjoin="foreign(MapLeaderboard.map_uid) == Map.map_uid")
 
-        q = db.session.query(ParsedReplay).filter(ParsedReplay.map_uid == self.map_uid)
-        q = q.filter(or_(ParsedReplay.uploader == player, ParsedReplay.login == player))
-        r = q.order_by(asc(ParsedReplay.race_time)).first()
-        return r
+    def set_campaign(self):
+        '''Fill the campaign columns from the mapname'''
 
-    def get_second_best_replay(self):
+        self.listed = self.mapname.startswith(LISTED_PREFIXES)
 
-        q = db.session.query(ParsedReplay).filter(ParsedReplay.map_uid == self.map_uid)
-        q = q.filter(ParsedReplay.login != self.get_best_replay().login)
-        results = q.order_by(asc(ParsedReplay.race_time)).all()
-        if not results or len(results) < 1:
-            return None
-        return results[0] # because first is already filtered out by login filter
+        campaign = tm2020parser.parse_campaign(self.mapname)
+        if campaign:
+            self.season, self.year, self.campaign_pos = campaign
+            self.season_order = tm2020parser.season_order(self.season, self.year)
+        else:
+            self.season = self.year = self.season_order = self.campaign_pos = None
 
-    def get_record_replay_percent_diff(self):
+    def to_dict(self):
 
-        best = self.get_best_replay()
-        second = self.get_second_best_replay()
+        d = dict()
+        d.update({ "mapname" : self.mapname })
+        d.update({ "map_uid" : self.map_uid })
 
-        if not second:
-            return ""
-        elif best.race_time == second.race_time:
-            return "Tied by {}".format(second.clean_login())
+        entry = self.leaderboard
+        if entry and entry.best_filehash:
+            d.update({ "record" : human_readable_time(entry.best_race_time, self.game) })
+            d.update({ "holder" : clean_login(entry.best_login) })
         else:
-            dif = second.race_time - best.race_time
-            percent = dif/best.race_time*100
-            return "+ {:.2f}% by {}".format(percent, second.clean_login())
+            d.update({ "record" : "-", "holder" : "-" })
 
-    def get_best_replay_repr(self):
-        r = self.get_best_replay()
-        if not r:
-            return "-"
-        return str(r)
+        d.update({ "replays" : entry.replay_count if entry else 0 })
+        last_activity = entry.last_activity if entry else None
+        d.update({ "last_activity" : last_activity.isoformat() if last_activity else None })
+        return d
 
-    def get_best_replay_age(self):
+class MapLeaderboard(db.Model):
+    '''Materialized record & runner-up per map, maintained on upload'''
+
+    __tablename__ = "leaderboard"
+    __table_args__ = (
+        Index("ix_leaderboard_record_dt", "record_dt"),
+    )
+
+    map_uid = Column(String, primary_key=True)
 
-        parsed = datetime.datetime.fromisoformat(self.get_best_replay().upload_dt)
-        delta = datetime.datetime.now() - parsed
-        return delta.days
+    best_filehash    = Column(String)
+    best_race_time   = Column(Integer)
+    best_login       = Column(String)
+    record_dt        = Column(DateTime)
+
+    # runner-up is the best replay of a login different from the record holder #
+    second_filehash  = Column(String)
+    second_race_time = Column(Integer)
+    second_login     = Column(String)
+
+    # activity summary for the map listing #
+    replay_count     = Column(Integer)
+    last_activity    = Column(DateTime)
+
+    def set_best(self, replay):
+        self.best_filehash = replay.filehash
+        self.best_race_time = replay.race_time
+        self.best_login = replay.login
+        self.record_dt = replay.upload_dt
+
+    def set_second(self, replay):
+        self.second_filehash = replay.filehash
+        self.second_race_time = replay.race_time
+        self.second_login = replay.login
 
 class UserSettings(db.Model):
 
@@ -119,36 +191,110 @@ class UserSettings(db.Model):
     notifications_all     = Column(Boolean)
     notifications_self    = Column(Boolean)
 
-@app.route("/update-user-settings", methods=["GET", "POST"])
-def update_user_settings():
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in SETTINGS_KEYS)
 
-    user = flask.request.headers.get(app.config["AUTH_HEADER"])
-    user_helper = user or "anonymous"
+SETTINGS_KEYS = ("show_tm_2020", "show_tmnf", "show_tm_2020_current", "notifications_all",
+                    "notifications_self")
 
-    settings = db.session.query(UserSettings).filter(UserSettings.user==user_helper).first()
+DEFAULT_SETTINGS = { "show_tm_2020" : False, "show_tmnf" : False, "show_tm_2020_current" : True,
+                        "notifications_self" : True, "notifications_all" : False }
 
-    # handle new settings #/
-    if not settings:
-        settings = UserSettings(user=user_helper, show_tm_2020=False, show_tmnf=False,
-                                    show_tm_2020_current=True, notifications_self=True,
-                                    notifications_all=False)
-        db.session.add(settings)
+class SettingsCache():
+    '''Settings per user as plain dicts (None if the user has none), dropped on write'''
+
+    MAX_USERS = 4096
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._versions = collections.Counter()
+
+    def get(self, user):
+
+        with self._lock:
+            if user in self._entries:
+                self._entries.move_to_end(user)
+                return self._entries[user]
+            version = self._versions[user]
+
+        settings = db.session.get(UserSettings, user)
+        value = settings.to_dict() if settings else None
+
+        # a write invalidated the user while loading, the value may predate it #
+        with self._lock:
+            if self._versions[user] == version:
+                self._entries[user] = value
+                while len(self._entries) > self.MAX_USERS:
+                    self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, user):
+        with self._lock:
+            self._entries.pop(user, None)
+            self._versions[user] += 1
+
+settings_cache = SettingsCache()
+
+def get_user_settings(user):
+    '''Settings of <user> as dict, None if the user never saved any'''
+    return settings_cache.get(user)
+
+def save_user_settings(user, values):
+    '''Apply all <values> (on top of the defaults for a new user) in one transaction'''
+
+    def apply():
+        settings = db.session.get(UserSettings, user)
+        if not settings:
+            settings = UserSettings(user=user, **DEFAULT_SETTINGS)
+            db.session.add(settings)
+        for key, value in values.items():
+            setattr(settings, key, value)
         db.session.commit()
-        settings = db.session.query(UserSettings).filter(UserSettings.user==user_helper).first()
+        return settings
+
+    try:
+        settings = apply()
+    except sqlalchemy.exc.IntegrityError:
+        # created concurrently by another request, apply on top of that row #
+        db.session.rollback()
+        settings = apply()
+    finally:
+        settings_cache.invalidate(user)
+
+    return settings.to_dict()
+
+def _check_settings_key(key):
+
+    if key not in SETTINGS_KEYS:
+        return "key {} not part of user settings".format(key)
+    return None
+
+@app.route("/update-user-settings", methods=["GET", "POST"])
+def update_user_settings():
+    '''GET ?key=<key> returns one setting, GET without key and POST return all of them'''
 
+    user = flask.request.headers.get(app.config["AUTH_HEADER"])
+    user_helper = user or "anonymous"
 
     if flask.request.method == "GET":
 
-        key = flask.request.args.get("key")
+        # first access persists the defaults #
+        settings = get_user_settings(user_helper)
+        if settings is None:
+            settings = save_user_settings(user_helper, dict())
 
-        # some sanity checks #
+        key = flask.request.args.get("key")
         if not key:
-            return ("key missing in args", 422)
-        if key == "user" or key.startswith("_") or "sql" in key:
-            return ("key {} is not allowed".format(key), 422)
+            return flask.jsonify(settings)
+
+        error = _check_settings_key(key)
+        if error:
+            return (error, 422)
 
         # return attribute #
-        return (str(getattr(settings, key)), 200)
+        return (str(settings[key]), 200)
 
     elif flask.request.method == "POST":
         json_dict = flask.request.json
@@ -157,31 +303,59 @@ def update_user_settings():
         if not key_value_list:
             return ("'payload' field empty", 422)
 
+        # validate all elements before applying any #
+        values = dict()
         for el in key_value_list:
 
             key = el.get("key")
             value = el.get("value")
 
-            if key == "user" or key.startswith("_") or "sql" in key:
-                return ("key {} is not allowed".format(key), 422)
-
             if key is None or value is None:
                 return ("element in payload list does not contain key and value", 422)
 
-            try:
-                getattr(settings, key)
-                setattr(settings, key, bool(value))
-                db.session.merge(settings)
-                db.session.commit()
-                return ("", 204)
-            except AttributeError:
-                return ("key {} not part of user settings".format(key), 422)
+            error = _check_settings_key(key)
+            if error:
+                return (error, 422)
+
+            values.update({ key : bool(value) })
+
+        return flask.jsonify(save_user_settings(user_helper, values))
     else:
         raise AssertionError("Unsupported Method: {}".format(flask.request.method))
 
+def clean_login(login):
+    if "/" in login:
+        return login.split("/")[0]
+    else:
+        return login
+
+def human_readable_time(race_time, game):
+    t = datetime.timedelta(microseconds=race_time*1000)
+    t_string = str(t)
+    if t.seconds < 60*60:
+        t_string =  t_string[2:]
+    if t.microseconds != 0:
+        if game == "tmnf":
+            return t_string[:-4]
+        else:
+            return t_string[:-3]
+    return t_string + ".00"
+
 class ParsedReplay(db.Model):
 
     __tablename__ = "replays"
+    __table_args__ = (
+        Index("ix_replays_map_uid_race_time", "map_uid", "race_time"),
+        Index("ix_replays_login_map_uid", "login", "map_uid"),
+        Index("ix_replays_uploader", "uploader"),
+        Index("ix_replays_upload_dt", "upload_dt"),
+
+        # prefix search with LIKE independent of the database collation (postgres only) #
+        Index("ix_replays_login_pattern", "login",
+                postgresql_ops={ "login" : "text_pattern_ops" }).ddl_if(dialect="postgresql"),
+        Index("ix_replays_uploader_pattern", "uploader",
+                postgresql_ops={ "uploader" : "text_pattern_ops" }).ddl_if(dialect="postgresql"),
+    )
 
     filehash    = Column(String, primary_key=True)
 
@@ -190,32 +364,23 @@ class ParsedReplay(db.Model):
 
     uploader    = Column(String)
     filepath    = Column(String)
-    upload_dt   = Column(String)
+    upload_dt   = Column(DateTime)
 
     map_uid     = Column(String) # ghost_uid
     login       = Column(String)
+    cp_splits   = Column(LargeBinary) # packed int32, see cpanalytics #
+
+    # legacy comma-joined checkpoint times, converted to cp_splits on startup #
     cp_times    = Column(String)
 
     login_uid_tm2020 = Column(String)
     game = Column(String)
 
     def clean_login(self):
-        if "/" in self.login:
-            return self.login.split("/")[0]
-        else:
-            return self.login
+        return clean_login(self.login)
 
     def get_human_readable_time(self):
-        t = datetime.timedelta(microseconds=self.race_time*1000)
-        t_string = str(t)
-        if t.seconds < 60*60:
-            t_string =  t_string[2:]
-        if t.microseconds != 0:
-            if self.game == "tmnf":
-                return t_string[:-4]
-            else:
-                return t_string[:-3]
-        return t_string + ".00"
+        return human_readable_time(self.race_time, self.game)
 
     def __repr__(self):
         return "{time} on {map_n} by {login}".format(
@@ -228,21 +393,168 @@ class ParsedReplay(db.Model):
         d.update({ "filehash" : self.filehash })
         d.update({ "race_time" : self.get_human_readable_time() })
         d.update({ "filepath" : self.filepath })
-        d.update({ "upload_dt" : self.upload_dt })
+        d.update({ "upload_dt" : self.upload_dt.isoformat() if self.upload_dt else None })
         return d
 
+class Job(db.Model):
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+
+    id         = Column(Integer, primary_key=True)
+    kind       = Column(String)
+    payload    = Column(String)
+    status     = Column(String)
+    attempts   = Column(Integer)
+    last_error = Column(String)
+
+    run_after  = Column(DateTime)
+    created    = Column(DateTime)
+    updated    = Column(DateTime)
+
+class RecordEvent(db.Model):
+    '''A broken record waiting to be included in the next notification digest'''
+
+    __tablename__ = "record_events"
+    __table_args__ = (
+        Index("ix_record_events_dispatched", "dispatched"),
+    )
+
+    id            = Column(Integer, primary_key=True)
+    map_uid       = Column(String)
+    old_filehash  = Column(String)
+    new_filehash  = Column(String)
+    created       = Column(DateTime)
+    dispatched    = Column(DateTime)
+
+class ParseResult(db.Model):
+    '''Values derived from a replay file by a given parser version'''
+
+    __tablename__ = "parse_cache"
+
+    filehash         = Column(String, primary_key=True)
+    parser_version   = Column(Integer, primary_key=True)
+
+    map_uid          = Column(String)
+    login            = Column(String)
+    login_uid_tm2020 = Column(String)
+    race_time        = Column(Integer)
+    ghost_id         = Column(Integer)
+    game             = Column(String)
+    cp_splits        = Column(LargeBinary)
+
+    # files which failed to parse are cached as well #
+    error            = Column(String)
+
+REINDEX_FIELDS = ("map_uid", "login", "login_uid_tm2020", "race_time", "ghost_id", "game",
+                    "cp_splits")
+
+def parse_result_from(source, filehash, error=None):
+    '''Build a parse cache entry from a ghost wrapper or replay'''
+
+    result = ParseResult(filehash=filehash, parser_version=tm2020parser.PARSER_VERSION, error=error)
+    if source:
+        for field in REINDEX_FIELDS:
+            setattr(result, field, getattr(source, field))
+    return result
+
+job_queue = jobqueue.JobQueue(app, db, Job, workers=int(os.environ.get("JOB_WORKERS") or 2),
+                    retention=int(os.environ.get("JOB_RETENTION") or 7 * 24 * 3600))
+
+def prefix_filter(col, prefix):
+    '''Case-sensitive prefix match that can be served from an index'''
+
+    # comparisons follow the database collation on postgres, LIKE on text_pattern_ops does not #
+    if db.engine.dialect.name == "postgresql":
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return col.like(escaped + "%", escape="\\")
+
+    # sqlite compares binary, LIKE would be case-insensitive #
+    return and_(col >= prefix, col < prefix + "\uffff")
+
+class DataTableCache():
+    '''Counts and keyset bookmarks for DataTable queries, dropped per map on upload'''
+
+    MAX_BOOKMARKS = 4096
+    MAX_COUNTS = 4096
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.OrderedDict()
+        self._bookmarks = collections.OrderedDict()
+        self._versions = collections.Counter()
+
+    def version(self, map_uid):
+        '''Invalidation counter of <map_uid>, read before computing a value to store'''
+        with self._lock:
+            return self._versions[map_uid]
+
+    def _store(self, cache, limit, key, value, version):
+
+        # an upload invalidated the map while computing, the value may predate it #
+        if self._versions[key[0]] != version:
+            return
+
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+    def count(self, key, query):
+
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+            version = self._versions[key[0]]
+
+        result = query.count()
+        with self._lock:
+            self._store(self._counts, self.MAX_COUNTS, key, result, version)
+        return result
+
+    def get_bookmark(self, key):
+        with self._lock:
+            return self._bookmarks.get(key)
+
+    def set_bookmark(self, key, value, version):
+        with self._lock:
+            self._store(self._bookmarks, self.MAX_BOOKMARKS, key, value, version)
+
+    def invalidate(self, map_uid):
+        '''Drop everything for <map_uid> and for the unfiltered (all maps) queries'''
+
+        with self._lock:
+            for scope in (map_uid, None):
+                self._versions[scope] += 1
+            for cache in (self._counts, self._bookmarks):
+                for key in [k for k in cache if k[0] in (map_uid, None)]:
+                    del cache[key]
+
+datatable_cache = DataTableCache()
+
 class DataTable():
 
     def __init__(self, d, cols):
-        self.draw  = int(d["draw"])
-        self.start = int(d["start"])
-        self.length = int(d["length"])
-        self.trueLength = -1
-        self.searchValue = d["search[value]"]
-        self.searchIsRegex = d["search[regex]"]
-        self.cols = cols
-        self.orderByCol = int(d["order[0][column]"])
-        self.orderDirection = d["order[0][dir]"]
+
+        try:
+            self.draw  = int(d["draw"])
+            self.start = int(d["start"])
+            self.length = int(d["length"])
+            self.trueLength = -1
+            self.searchValue = d["search[value]"]
+            self.searchIsRegex = d["search[regex]"]
+            self.cols = cols
+            self.orderByCol = int(d["order[0][column]"])
+            self.orderDirection = d["order[0][dir]"]
+        except (KeyError, ValueError):
+            abort(400, "Malformed DataTable request")
+
+        # the column is used to pick the order attribute #
+        if not 0 <= self.orderByCol < len(cols) or self.start < 0:
+            abort(400, "Order column or start out of range")
 
         # order variable for use with pythong sorted etc #
         self.orderAsc = self.orderDirection == "asc"
@@ -279,92 +591,120 @@ class DataTable():
 
         return d
 
-    def get(self, map_uid=None):
+    def _page(self, query, order_col, key_col, cache_key, bookmark_of=None):
+        '''Fetch the requested page, seeking from a bookmark instead of OFFSET if possible
 
-        filtered = 0
-        total    = 0
+        bookmark_of(row) returns the (order value, key) of a result row, by default
+        the attributes named like the columns.
+        '''
+
+        if not bookmark_of:
+            bookmark_of = lambda row: (getattr(row, order_col.key), getattr(row, key_col.key))
+
+        query = query.order_by(self.orderAscDbClass(order_col), self.orderAscDbClass(key_col))
+        version = datatable_cache.version(cache_key[0])
+        bookmark = datatable_cache.get_bookmark(cache_key + (self.start,))
+
+        if self.start > 0 and bookmark:
+            value, key = bookmark
+            if self.orderAsc:
+                seek = or_(order_col > value, and_(order_col == value, key_col > key))
+            else:
+                seek = or_(order_col < value, and_(order_col == value, key_col < key))
+            query = query.filter(seek)
+        elif self.start > 0:
+            query = query.offset(self.start)
+
+        if self.length >= 0:
+            query = query.limit(self.length)
+
+        results = query.all()
+
+        # remember where the next page starts (NULLs can't be seeked from) #
+        if results:
+            next_bookmark = bookmark_of(results[-1])
+            if next_bookmark[0] is not None:
+                datatable_cache.set_bookmark(cache_key + (self.start + len(results),),
+                                                next_bookmark, version)
+
+        return results
+
+    def get(self, map_uid=None):
 
         # base query
         query = db.session.query(ParsedReplay)
         if map_uid:
-            print("Filter for map: {}".format(map_uid))
             query = query.filter(ParsedReplay.map_uid == map_uid)
 
-        total = query.count()
+        total = datatable_cache.count((map_uid, ""), query)
         if self.searchValue:
 
-            # search string (search for all substrings individually #
-            filterQuery = query
+            # every search term must be a prefix of the login or the uploader #
+            for term in self.searchValue.split():
+                query = query.filter(or_(prefix_filter(ParsedReplay.login, term),
+                                            prefix_filter(ParsedReplay.uploader, term)))
 
-            for substr in self.searchValue.split(" "):
-                searchSubstr = "%{}%".format(substr.strip())
-                filterQuery  = filterQuery.filter(ParsedReplay.tags.like(searchSubstr))
-
-            filtered = filterQuery.count()
-            results = filterQuery.offset(self.start).limit(self.length).all()
+            filtered = datatable_cache.count((map_uid, self.searchValue), query)
 
         else:
-
-            query  = query.order_by(self.orderAscDbClassReverse(ParsedReplay.race_time))
-            results  = query.offset(self.start).limit(self.length).all()
             filtered = total
 
+        # order by the requested column, filehash makes the order total #
+        order_col = getattr(ParsedReplay, self.cols[self.orderByCol])
+        cache_key = (map_uid, self.searchValue, order_col.key, self.orderDirection)
+
+        results = self._page(query, order_col, ParsedReplay.filehash, cache_key)
         return self.__build(results, total, filtered)
 
     def get_all_maps(self):
 
-        filtered = 0
-        total    = 0
+        # maps with their leaderboard summary, without loading the replays #
+        query = db.session.query(Map).outerjoin(MapLeaderboard,
+                                                MapLeaderboard.map_uid == Map.map_uid)
+        query = query.options(sqlalchemy.orm.contains_eager(Map.leaderboard).lazyload("*"))
 
-        # base query
-        query = db.session.query(Map)
-        total = query.count()
+        total = datatable_cache.count((None, ("maps", "")), query)
         if self.searchValue:
 
             # search string (search for all substrings individually #
-            filterQuery = query
-
-            for substr in self.searchValue.split(" "):
+            for substr in self.searchValue.split():
                 searchSubstr = "%{}%".format(substr.strip())
-                filterQuery  = filterQuery.filter(Map.mapname.like(searchSubstr))
+                query = query.filter(Map.mapname.like(searchSubstr))
 
-            filtered = filterQuery.count()
-            results = filterQuery.offset(self.start).limit(self.length).all()
+            filtered = datatable_cache.count((None, ("maps", self.searchValue)), query)
 
         else:
-
-            query  = query.order_by(self.orderAscDbClassReverse(Map.mapname))
-            results  = query.offset(self.start).limit(self.length).all()
             filtered = total
 
-        return self.__build(results, total, filtered)
-
-def _extracted_login_from_file(fullpath):
-    '''Extract a login from a tmnf 2020 replay manually'''
+        order_col = MAP_ORDER_COLUMNS[self.cols[self.orderByCol]]
+        cache_key = (None, ("maps", self.searchValue), order_col.key, self.orderDirection)
 
-    # TODO fix underscores in filenames #
-    if "its_a_sheppy" in fullpath:
-        login_from_filename = "its_a_sheppy"
-    else:
-        login_from_filename = os.path.basename(fullpath).split("_")[0]
+        def bookmark_of(m):
+            owner = m.leaderboard if order_col.class_ is MapLeaderboard else m
+            return (getattr(owner, order_col.key) if owner else None, m.map_uid)
 
-    with open(fullpath, "rb") as f:
-        content = f.read()
-        decoded_string = content.decode("ascii", errors="ignore")
-        if login_from_filename not in decoded_string:
-            raise ValueError("Login indicated by filename does not match login in file")
+        results = self._page(query, order_col, Map.map_uid, cache_key, bookmark_of)
+        return self.__build(results, total, filtered)
 
-    return login_from_filename
+MAP_ORDER_COLUMNS = {
+    "mapname" : Map.mapname,
+    "record" : MapLeaderboard.best_race_time,
+    "holder" : MapLeaderboard.best_login,
+    "replays" : MapLeaderboard.replay_count,
+    "last_activity" : MapLeaderboard.last_activity,
+}
 
+def map_from_replay(replay):
+    '''Build the database map object of a replay (maps are named by their uid)'''
 
-def replay_from_path(fullpath, uploader=None):
-    '''Load a replay from uploaded path'''
+    m = Map(map_uid=replay.map_uid, mapname=replay.map_uid, game=replay.game)
+    m.set_campaign()
+    return m
 
-    # use ghost wrapper to parse both tmnf and tm2020 #
-    ghost = tm2020parser.GhostWrapper(fullpath, uploader)
+def replay_from_ghost(ghost):
+    '''Build a database replay from a parsed ghost wrapper'''
 
-    # build a database replay from ghost wrapper #
-    replay = ParsedReplay(filehash=ghost.filehash,
+    return ParsedReplay(filehash=ghost.filehash,
                         race_time=ghost.race_time,
                         uploader=ghost.uploader,
                         filepath=ghost.fullpath,
@@ -373,41 +713,143 @@ def replay_from_path(fullpath, uploader=None):
                         login=ghost.login,
                         login_uid_tm2020=ghost.login_uid_tm2020,
                         upload_dt=ghost.upload_dt,
-                        cp_times=ghost.cp_times,
+                        cp_splits=ghost.cp_splits,
                         game=ghost.game)
 
-    # build database map object from replay #
-    m = Map(map_uid=replay.map_uid, mapname=replay.map_uid, game=replay.game)
+def _apply_to_leaderboard(entry, replay):
+    '''Update a leaderboard entry in place with a newly inserted replay'''
+
+    entry.replay_count = (entry.replay_count or 0) + 1
+    if not entry.last_activity or replay.upload_dt > entry.last_activity:
+        entry.last_activity = replay.upload_dt
+
+    if entry.best_filehash is None:
+        entry.set_best(replay)
+    elif replay.race_time < entry.best_race_time:
+
+        # the old record becomes the runner-up unless it was the same login #
+        if replay.login != entry.best_login:
+            entry.second_filehash = entry.best_filehash
+            entry.second_race_time = entry.best_race_time
+            entry.second_login = entry.best_login
+
+        entry.set_best(replay)
+
+    elif replay.login != entry.best_login:
+        if entry.second_filehash is None or replay.race_time < entry.second_race_time:
+            entry.set_second(replay)
+
+
+def update_leaderboard(replay):
+    '''Incrementally update the leaderboard for a new replay'''
+
+    # re-read & lock the entry, a concurrent upload to the same map may have changed it  #
+    # since it was loaded (sqlite: the replay insert before already holds the write lock) #
+    entry = db.session.get(MapLeaderboard, replay.map_uid, with_for_update=True,
+                                populate_existing=True)
+    if not entry:
+        entry = MapLeaderboard(map_uid=replay.map_uid)
+        db.session.add(entry)
+
+    _apply_to_leaderboard(entry, replay)
+
+def rebuild_leaderboard():
+    '''Recompute the leaderboard table from all replays (in upload order)'''
+
+    db.session.query(MapLeaderboard).delete()
+
+    entries = dict()
+
+    replays = db.session.query(ParsedReplay).order_by(asc(ParsedReplay.upload_dt))
+    for replay in replays:
 
-    # merge the map & commit and return the replay #
-    db.session.merge(m)
+        entry = entries.setdefault(replay.map_uid, MapLeaderboard(map_uid=replay.map_uid))
+        _apply_to_leaderboard(entry, replay)
+
+    db.session.add_all(entries.values())
     db.session.commit()
-    return replay
+    print("Rebuilt leaderboard for {} maps".format(len(entries)))
+
+def days_since(column, now):
+    '''Whole days elapsed between a timestamp column and <now>, computed by the database'''
+
+    now = sqlalchemy.literal(now, DateTime)
+    if db.engine.dialect.name == "postgresql":
+        seconds = sqlalchemy.extract("epoch", now - column)
+        return sqlalchemy.cast(sqlalchemy.func.floor(seconds / 86400), Integer)
+
+    return sqlalchemy.cast(sqlalchemy.func.julianday(now) - sqlalchemy.func.julianday(column),
+                                Integer)
+
+def week_of(column):
+    '''Monday of the week of a timestamp column, as an ISO date'''
+
+    if db.engine.dialect.name == "postgresql":
+        return sqlalchemy.cast(sqlalchemy.func.date_trunc("week", column), sqlalchemy.Date)
+
+    return sqlalchemy.func.date(column, "weekday 0", "-6 days")
+
+def login_positions(*filters):
+    '''Subquery of each login's best replay per map with its position on that map'''
+
+    cols = (ParsedReplay.map_uid, ParsedReplay.login, ParsedReplay.race_time,
+                ParsedReplay.game, ParsedReplay.upload_dt)
+
+    # best replay per (map, login), so multiple replays of one player count once #
+    login_pos = sqlalchemy.func.row_number().over(
+                    partition_by=(ParsedReplay.map_uid, ParsedReplay.login),
+                    order_by=(asc(ParsedReplay.race_time), asc(ParsedReplay.upload_dt)))
+    per_login = db.session.query(*cols, login_pos.label("login_pos")).filter(*filters).subquery()
+
+    pos = sqlalchemy.func.row_number().over(
+                    partition_by=per_login.c.map_uid,
+                    order_by=(asc(per_login.c.race_time), asc(per_login.c.upload_dt)))
+    ranked = db.session.query(per_login, pos.label("pos")).filter(per_login.c.login_pos == 1)
+    return ranked.subquery()
+
+MAX_RANK = 10
+_rank_cache = { "version" : 0 }
+_rank_cache_lock = threading.Lock()
+
+def invalidate_rank_cache():
+    with _rank_cache_lock:
+        _rank_cache.pop("counts", None)
+        _rank_cache["version"] += 1
+
+def get_rank_counts():
+    '''Count how often each login holds positions 1..MAX_RANK, cached until next upload'''
+
+    with _rank_cache_lock:
+        cached = _rank_cache.get("counts")
+        version = _rank_cache["version"]
+    if cached is not None:
+        return cached
+
+    ranked = login_positions()
+    count = sqlalchemy.func.count().label("count")
+    query = db.session.query(ranked.c.pos, ranked.c.login, count).filter(ranked.c.pos <= MAX_RANK)
+    query = query.group_by(ranked.c.pos, ranked.c.login).order_by(asc(ranked.c.pos), desc(count))
+
+    counts = dict((rank, dict()) for rank in range(1, MAX_RANK + 1))
+    for rank, login, count in query:
+        counts[rank].update({ login : count })
+
+    # an upload committed while counting, the counts may predate it #
+    with _rank_cache_lock:
+        if _rank_cache["version"] == version:
+            _rank_cache.update({ "counts" : counts })
+    return counts
 
 def get_number_of_rank_x(rank):
 
     rank = int(rank)
-    if rank < 1 or rank > 10:
-        raise ValueError("Rank query must be between 1 and 10 (was {}".format(rank))
-
-    rank_query = '''SELECT login,COUNT(login)
-                    FROM (SELECT dISTINCT login||map_uid as dis, login, map_uid
-                            FROM replays r
-                            WHERE r.login IN (
-                                SELECT login FROM replays r2
-                                WHERE r2.map_uid = r.map_uid
-                                ORDER BY r2.race_time ASC
-                                LIMIT {limit}
-                                OFFSET {offset}
-                            )
-                    )
-                  GROUP BY login;'''.format(limit=rank, offset=rank-1)
-
-    sql_query = sqlalchemy.sql.text(rank_query)
-    result = db.session.execute(sql_query).all()
-    return dict((login, count) for login, count in sorted(result, key=lambda x: x[1], reverse=True))
+    if rank < 1 or rank > MAX_RANK:
+        raise ValueError("Rank query must be between 1 and {} (was {})".format(MAX_RANK, rank))
+
+    return get_rank_counts()[rank]
 
 @app.route("/ranking-overview")
+@response_cache.cached()
 def ranks():
 
     rank_dict = {
@@ -418,61 +860,303 @@ def ranks():
     return flask.render_template("rank-info.html", rank_dict=rank_dict)
 
 
+def split_analysis(map_uid):
+    '''Checkpoint analysis of all replays of a map, cached until the next upload to it'''
+
+    def compute():
+        query = db.session.query(ParsedReplay.login, ParsedReplay.race_time,
+                                    ParsedReplay.cp_splits)
+        return cpanalytics.analyze_rows(query.filter(ParsedReplay.map_uid == map_uid).all())
+
+    return response_cache.fragment(("split-analysis", map_uid), map_uid, compute)
+
+def signed_ms(ms):
+    return "{:+.3f}".format(ms / 1000)
+
 @app.route("/map-info")
 def map_info():
     player = flask.request.headers.get(app.config["AUTH_HEADER"])
     header_col = ["Player", "Time", "Date", "Replay"]
     map_uid = flask.request.args.get("map_uid")
+    m = db.session.get(Map, map_uid) if map_uid else None
+    analysis = split_analysis(map_uid) if m else None
     return flask.render_template("map-info.html", header_col=header_col, map_uid=map_uid,
-                                    player=player)
+                                    player=player, analysis=analysis, game=m.game if m else None,
+                                    human_readable_time=human_readable_time,
+                                    clean_login=clean_login, signed_ms=signed_ms)
 
-@app.route("/")
-def mapnames():
-    '''Index Location'''
+class ReplayRow():
+    '''Plain, session-independent view of a replay for template rendering'''
 
-    # TODO list by user
+    def __init__(self, login, race_time, game, upload_dt, age=None):
+        self.login = login
+        self.race_time = race_time
+        self.game = game
+        self.upload_dt = upload_dt
+        self.age = age
+
+    def clean_login(self):
+        return clean_login(self.login)
+
+    def get_human_readable_time(self):
+        return human_readable_time(self.race_time, self.game)
+
+class IndexRow():
+    '''One row of the index table: record, runner-up and the viewer's personal best'''
+
+    def __init__(self, map_uid, mapname, game):
+        self.map_uid = map_uid
+        self.mapname = mapname
+        self.game = game
+        self.best = None
+        self.second = None
+        self.personal_best = None
+
+    def get_record_replay_percent_diff(self):
+
+        if not self.second:
+            return ""
+        elif self.best.race_time == self.second.race_time:
+            return "Tied by {}".format(self.second.clean_login())
+        else:
+            dif = self.second.race_time - self.best.race_time
+            percent = dif/self.best.race_time*100
+            return "+ {:.2f}% by {}".format(percent, self.second.clean_login())
+
+    def get_best_replay_age(self):
+
+        if not self.best:
+            return "-"
+
+        return self.best.age
+
+def load_index_rows(maps, player):
+    '''Record & runner-up from the leaderboard (loaded with the maps), personal bests in one query'''
+
+    now = datetime.datetime.now()
+    rows = dict()
+    for m in maps:
+
+        row = IndexRow(m.map_uid, m.mapname, m.game)
+        entry = m.leaderboard
+        if entry and entry.best_filehash:
+            age = (now - entry.record_dt).days if entry.record_dt else None
+            row.best = ReplayRow(entry.best_login, entry.best_race_time, m.game, entry.record_dt,
+                                    age)
+        if entry and entry.second_filehash:
+            row.second = ReplayRow(entry.second_login, entry.second_race_time, m.game, None)
+
+        rows[m.map_uid] = row
+
+    if not rows:
+        return []
+
+    map_filter = ParsedReplay.map_uid.in_(list(rows.keys()))
+
+    # personal best of the viewer (as uploader or login in the file) #
+    pb_pos = sqlalchemy.func.row_number().over(
+                    partition_by=ParsedReplay.map_uid,
+                    order_by=(asc(ParsedReplay.race_time), asc(ParsedReplay.upload_dt)))
+    cols = (ParsedReplay.map_uid, ParsedReplay.login, ParsedReplay.race_time,
+                ParsedReplay.game, ParsedReplay.upload_dt)
+    pb_query = db.session.query(*cols, pb_pos.label("pos")).filter(map_filter)
+    pb_query = pb_query.filter(or_(ParsedReplay.uploader == player, ParsedReplay.login == player))
+    pb_ranked = pb_query.subquery()
+
+    for r in db.session.query(pb_ranked).filter(pb_ranked.c.pos == 1):
+        rows[r.map_uid].personal_best = ReplayRow(r.login, r.race_time, r.game, r.upload_dt)
+
+    return list(rows.values())
+
+def viewer_cache_key():
+    '''Key part for pages that depend on the viewer, their settings and the day (ages)'''
+
+    today = datetime.date.today().isoformat()
     player = flask.request.headers.get(app.config["AUTH_HEADER"]) or "anonymous"
-    maps_query = db.session.query(Map).order_by(asc(Map.mapname))
+    settings = get_user_settings(player)
+    if not settings:
+        return (player, None, today)
+
+    return (player, tuple(sorted(settings.items())), today)
+
+def index_maps_query(player):
+    '''Maps listed on the index for <player>, after ?campaign= and their settings'''
+
+    maps_query = db.session.query(Map).filter(Map.listed.is_(True)).order_by(asc(Map.mapname))
+
+    # a single campaign, e.g. ?campaign=Fall 2024 #
+    campaign = flask.request.args.get("campaign")
+    if campaign:
+        season, _, year = campaign.partition(" ")
+        if season not in tm2020parser.SEASON_ORDERING or not year.isdigit():
+            abort(400, "campaign must look like 'Fall 2024'")
+        maps_query = maps_query.filter(
+                        Map.season_order == tm2020parser.season_order(season, int(year)))
 
     # limit leaderboard to game #
-    settings = db.session.query(UserSettings).filter(UserSettings.user==player).first()
+    settings = get_user_settings(player)
     if settings:
-        if not settings.show_tm_2020 and not settings.show_tmnf:
+        if not settings["show_tm_2020"] and not settings["show_tmnf"]:
             maps_query = maps_query.filter(Map.game=="tm2020")
-            latest_season = tm2020parser.get_latest_season_from_maps(maps_query.all())
+            latest_season = db.session.query(sqlalchemy.func.max(Map.season_order)).scalar()
             # handle no replays #
-            if latest_season:
-                maps_query = maps_query.filter(Map.map_uid.like("{}%".format(latest_season)))
-        elif settings.show_tm_2020 and not settings.show_tmnf:
+            if latest_season is not None:
+                maps_query = maps_query.filter(Map.season_order == latest_season)
+        elif settings["show_tm_2020"] and not settings["show_tmnf"]:
             maps_query = maps_query.filter(Map.game=="tm2020")
-        elif not settings.show_tm_2020 and settings.show_tmnf:
+        elif not settings["show_tm_2020"] and settings["show_tmnf"]:
             maps_query = maps_query.filter(Map.game=="tmnf")
         else:
             pass
 
-    maps = maps_query.all()
+    # latest season of the current year #
+    if settings and settings["show_tm_2020_current"]:
+        current = db.session.query(sqlalchemy.func.max(Map.season_order))
+        current = current.filter(Map.year == datetime.datetime.now().year).scalar_subquery()
+        maps_query = maps_query.filter(Map.season_order == current)
+
+    return maps_query
+
+@app.route("/")
+@response_cache.cached(vary=viewer_cache_key)
+def mapnames():
+    '''Index Location'''
+
+    # TODO list by user
+    player = flask.request.headers.get(app.config["AUTH_HEADER"]) or "anonymous"
+    rows = load_index_rows(index_maps_query(player).all(), player)
+    return flask.render_template("index.html", maps=rows, player=player)
+
+@app.route("/index-rows")
+@response_cache.cached(vary=viewer_cache_key)
+def index_rows():
+    '''Table rows of the index, only those of the given ?map_uid= if any (live updates)'''
+
+    player = flask.request.headers.get(app.config["AUTH_HEADER"]) or "anonymous"
+    maps_query = index_maps_query(player)
+
+    map_uids = flask.request.args.getlist("map_uid")
+    if map_uids:
+        maps_query = maps_query.filter(Map.map_uid.in_(map_uids))
+
+    rows = load_index_rows(maps_query.all(), player)
+    return flask.render_template("index-rows.html", maps=rows, player=player)
+
+def _parse_since(value):
+    '''Parse ?since= as unix timestamp or ISO datetime'''
 
-    # FIXME better handling for unwanted maps #
-    allowed = ("A", "B", "C", "D", "E", "Fall", "Winter", "Spring", "Summer")
-    maps_filtered = filter(lambda m: m.mapname.startswith(allowed), maps)
+    try:
+        return datetime.datetime.fromtimestamp(float(value))
+    except (OverflowError, OSError):
+        abort(400, "since is out of range")
+    except ValueError:
+        pass
 
-    if settings and settings.show_tm_2020_current:
-        maps_filtered = filter_for_current_season(maps_filtered)
+    try:
+        since = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, "since must be a unix timestamp or an ISO datetime")
 
-    return flask.render_template("index.html", maps=maps_filtered, player=player)
+    # timestamps are stored as naive local time #
+    if since.tzinfo is not None:
+        since = since.astimezone().replace(tzinfo=None)
+
+    return since
+
+def _open_info_data(since):
+
+    query = db.session.query(Map.mapname, MapLeaderboard.best_login,
+                                MapLeaderboard.best_race_time, MapLeaderboard.record_dt)
+    query = query.join(MapLeaderboard, MapLeaderboard.map_uid == Map.map_uid)
+    query = query.filter(MapLeaderboard.best_filehash.isnot(None))
+
+    if since:
+        query = query.filter(MapLeaderboard.record_dt > since)
+
+    data = dict()
+    for mapname, login, race_time, record_dt in query.order_by(asc(Map.mapname)):
+        data.update({ mapname : { "player" : clean_login(login), "time" : race_time,
+                                    "record_dt" : record_dt.isoformat() } })
+
+    return data
+
+def _open_info_payload(since):
+    '''Records since <since> and an ETag derived from their content'''
+
+    data = _open_info_data(since)
+    body = json.dumps(data, sort_keys=True)
+    return data, hashlib.sha1(body.encode("utf-8")).hexdigest()
 
 @app.route("/open-info")
 def openinfo():
-    maps = db.session.query(Map).order_by(asc(Map.mapname)).all()
-    data = dict()
+    '''Current records as JSON, optionally only those set after ?since=<timestamp>'''
 
-    for m in maps:
+    since = flask.request.args.get("since")
+    if since:
+        since = _parse_since(since)
+
+    # the ETag is cached with the data, so it changes with whatever changes the records #
+    data, etag = response_cache.fragment(("open-info", since), responsecache.GLOBAL_SCOPE,
+                                            lambda: _open_info_payload(since))
+
+    if flask.request.if_none_match.contains(etag):
+        r = flask.Response(status=304)
+        r.set_etag(etag)
+        return r
+
+    r = flask.jsonify(data)
+    r.set_etag(etag)
+    r.headers["Cache-Control"] = "no-cache"
+    return r
+
+def _int_arg(name, default, maximum):
+
+    try:
+        value = int(flask.request.args.get(name, default))
+    except ValueError:
+        abort(400, "{} must be an integer".format(name))
 
-        best_replay = m.get_best_replay()
-        player = best_replay.clean_login()
-        race_time = best_replay.race_time
-        data.update( { m.mapname : { "player" : player, "time" : race_time } } )
+    if value < 1 or value > maximum:
+        abort(400, "{} must be between 1 and {}".format(name, maximum))
 
+    return value
+
+@app.route("/recent-records")
+def recent_records():
+    '''Records set within the last ?days=<n> days, newest first'''
+
+    days = _int_arg("days", 7, 3650)
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+
+    query = db.session.query(Map.mapname, Map.map_uid, Map.game, MapLeaderboard.best_login,
+                                MapLeaderboard.best_race_time, MapLeaderboard.record_dt)
+    query = query.join(MapLeaderboard, MapLeaderboard.map_uid == Map.map_uid)
+    query = query.filter(MapLeaderboard.record_dt >= cutoff)
+
+    records = []
+    for mapname, map_uid, game, login, race_time, record_dt in query.order_by(
+                                                            desc(MapLeaderboard.record_dt)):
+        records.append({ "mapname" : mapname, "map_uid" : map_uid,
+                            "player" : clean_login(login),
+                            "time" : human_readable_time(race_time, game),
+                            "record_dt" : record_dt.isoformat() })
+
+    return flask.jsonify(records)
+
+@app.route("/activity")
+def activity():
+    '''Uploads and active players per week for the last ?weeks=<n> weeks'''
+
+    weeks = _int_arg("weeks", 12, 520)
+    cutoff = datetime.datetime.now() - datetime.timedelta(weeks=weeks)
+
+    week = week_of(ParsedReplay.upload_dt).label("week")
+    query = db.session.query(week, sqlalchemy.func.count(),
+                                sqlalchemy.func.count(sqlalchemy.distinct(ParsedReplay.login)))
+    query = query.filter(ParsedReplay.upload_dt >= cutoff).group_by(week).order_by(asc(week))
+
+    data = [ { "week" : str(w), "replays" : replays, "players" : players }
+                    for w, replays, players in query ]
     return flask.jsonify(data)
 
 @app.route("/data-source/<path:map_uid>", methods=["POST"])
@@ -480,170 +1164,1023 @@ def source(map_uid):
 
     # path = map_uid
     dt = DataTable(flask.request.form.to_dict(), ["login", "race_time", "upload_dt", "filehash" ])
-    jsonDict = dt.get(map_uid=map_uid)
+
+    # draw is a client-side sequence number, the rest of the result can be shared #
+    key = ("data-source", map_uid, dt.start, dt.length, dt.searchValue, dt.orderByCol,
+                dt.orderDirection)
+    jsonDict = dict(response_cache.fragment(key, map_uid, lambda: dt.get(map_uid=map_uid)))
+    jsonDict.update({ "draw" : dt.draw })
+
     return flask.Response(json.dumps(jsonDict), 200, mimetype='application/json')
 
 @app.route("/data-source-index", methods=["POST"])
-def index_source(map_uid):
+def index_source():
 
-    cols = ["mapname", "personal_"]
-    dt = DataTable(flask.request.form.to_dict(), )
-    jsonDict = dt.get(map_uid=map_uid)
+    cols = ["mapname", "record", "holder", "replays", "last_activity"]
+    dt = DataTable(flask.request.form.to_dict(), cols)
+    jsonDict = dt.get_all_maps()
     return flask.Response(json.dumps(jsonDict), 200, mimetype='application/json')
 
-import os
-import boto3
-import flask
-import werkzeug
-import sqlalchemy
+@app.route("/maps")
+def maps_overview():
+    header_col = ["Map", "Record", "Record Holder", "Replays", "Last Activity"]
+    return flask.render_template("maps.html", header_col=header_col)
 
-S3_BUCKET = os.getenv("S3_BUCKET")
+from s3storage import s3_enabled
 
-def s3_enabled():
-    return all([
-        os.getenv("AWS_ACCESS_KEY_ID"),
-        os.getenv("AWS_SECRET_ACCESS_KEY"),
-        S3_BUCKET
-    ])
+def upload_to_s3(local_path, replay):
+    key = f"{replay.filehash}"
+    return s3storage.upload_file(local_path, key)
 
-def get_s3_client():
-    kwargs = {}
+class UploadItem():
+    '''State of a single file during a (batch) upload'''
 
-    if S3_ENDPOINT_URL:
-        kwargs["endpoint_url"] = S3_ENDPOINT_URL
+    def __init__(self, fname, tmp_path, filehash):
+        self.fname = fname
+        self.tmp_path = tmp_path
+        self.filehash = filehash
+        self.ghost = None
+        self.replay = None
+        self.error = None
 
-    return boto3.client("s3", **kwargs)
+PARSE_POOL_MIN_FILES = 4
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
 
+def get_parse_pool():
+    '''Return the process pool used to parse large batches of uploads'''
 
-def upload_to_s3(local_path, replay):
-    s3 = get_s3_client()
-    key = f"{replay.filehash}"
-    s3.upload_file(local_path, S3_BUCKET, key)
-    return key
+    global _parse_pool
+    with _parse_pool_lock:
+        if not _parse_pool:
+            ctx = multiprocessing.get_context("spawn")
+            _parse_pool = concurrent.futures.ProcessPoolExecutor(
+                                max_workers=app.config["PARSE_WORKERS"], mp_context=ctx)
+        return _parse_pool
 
+def _reset_parse_pool():
 
-@app.route("/upload", methods=['GET', 'POST'])
-def upload():
+    global _parse_pool
+    with _parse_pool_lock:
+        _parse_pool = None
 
-    results = []
+def _stage_upload(f_storage):
+    '''Stream an upload to a temporary file, hashing it on the fly'''
 
-    uploader = flask.request.headers.get(app.config["AUTH_HEADER"])
+    fname = werkzeug.utils.secure_filename(f_storage.filename)
+    with replay_store.temp_file() as tmp_file:
+        filehash = tm2020parser.stream_to_file(f_storage.stream, tmp_file)
 
-    if flask.request.method == 'POST':
+    return UploadItem(fname, tmp_file.name, filehash)
 
-        f_list = flask.request.files.getlist("file[]")
+def _reject_known_uploads(items):
+    '''Skip parsing for replays we already have or that repeat within the batch'''
 
-        for f_storage in f_list:
+    hashes = [item.filehash for item in items]
+    query = db.session.query(ParsedReplay.filehash).filter(ParsedReplay.filehash.in_(hashes))
+    known = set(filehash for (filehash,) in query)
 
-            fname = werkzeug.utils.secure_filename(f_storage.filename)
+    for item in items:
+        if item.filehash in known:
+            item.error = "Replay was already uploaded"
+        known.add(item.filehash)
 
-            os.makedirs("uploads", exist_ok=True)
+def _parse_uploads(items, uploader):
+    '''Parse all pending items, using the process pool for larger batches'''
 
-            # temporary save
-            tmp_path = os.path.join("uploads", fname)
-            f_storage.save(tmp_path)
+    pending = [item for item in items if not item.error]
+    args = [(item.tmp_path, item.fname, uploader, item.filehash) for item in pending]
 
-            try:
-                replay = replay_from_path(tmp_path, uploader=uploader)
+    results = None
+    if len(pending) >= PARSE_POOL_MIN_FILES and app.config["PARSE_WORKERS"] > 1:
+        try:
+            results = list(get_parse_pool().map(tm2020parser.try_parse_replay_file, *zip(*args)))
+        except concurrent.futures.process.BrokenProcessPool:
+            print("Parse pool broken, parsing in request thread", file=sys.stderr)
+            _reset_parse_pool()
+
+    if results is None:
+        results = [tm2020parser.try_parse_replay_file(*a) for a in args]
+
+    for item, (ghost, error) in zip(pending, results):
+        item.ghost = ghost
+        item.error = error
+        if ghost:
+            metrics.GBX_PARSE_SECONDS.observe(ghost.parse_seconds, ghost.game)
+
+def _store_upload(item):
+    '''Move a parsed upload to its final location'''
+
+    item.replay.filepath = replay_store.commit(item.tmp_path, item.filehash)
+
+def _insert_replays(replays):
+    '''Add replays, their maps and leaderboard updates to the current transaction'''
+
+    maps = dict()
+    for replay in replays:
+        if replay.map_uid not in maps:
+            maps.update({ replay.map_uid : map_from_replay(replay) })
+    for m in maps.values():
+        db.session.merge(m)
+
+    # flushed as one multi-row insert, the parse results are cached for reindexing #
+    db.session.add_all(replays)
+    db.session.add_all([parse_result_from(replay, replay.filehash) for replay in replays])
+    db.session.flush()
+
+    for replay in replays:
+        update_leaderboard(replay)
+        db.session.flush()
+
+        # follow-up work is committed together with the replay #
+        if s3_enabled():
+            job_queue.enqueue("s3_upload", filehash=replay.filehash, path=replay.filepath)
+        check_replay_trigger(replay)
+
+def on_replays_committed(map_uids):
+    '''Invalidate everything derived from the replays of the given maps'''
+
+    invalidate_rank_cache()
+    for map_uid in map_uids:
+        datatable_cache.invalidate(map_uid)
+    response_cache.invalidate(map_uids)
+    publish_records(map_uids)
+
+def publish_records(map_uids):
+    '''Push the current record of the given maps to connected index pages'''
+
+    if not map_uids or not live_updates.has_subscribers():
+        return
 
-                new_basename = f"{replay.filehash}"
-                fullpath = os.path.join("uploads", new_basename)
+    query = db.session.query(MapLeaderboard.map_uid, MapLeaderboard.best_login,
+                                MapLeaderboard.best_race_time)
+    query = query.filter(MapLeaderboard.map_uid.in_(map_uids))
+    for map_uid, login, race_time in query:
+        live_updates.publish({ "map_uid" : map_uid, "race_time" : race_time,
+                                    "holder" : clean_login(login) if login else None })
 
-                os.rename(tmp_path, fullpath)
+@app.route("/events")
+def events():
+    '''Record changes as server-sent events, each stream ends after SSE_MAX_SECONDS
 
-                replay.filepath = fullpath
+    Every open stream holds a server thread for its whole duration, so the server
+    needs more threads than SSE_MAX_SUBSCRIBERS to keep serving normal requests.
+    Further clients are asked to retry later and refresh the index on their own.
+    '''
 
-                if s3_enabled():
-                    s3_key = upload_to_s3(fullpath, replay)
-                    os.remove(fullpath)
+    headers = { "Cache-Control" : "no-cache", "X-Accel-Buffering" : "no" }
+    if flask.request.method == "HEAD":
+        return flask.Response(mimetype="text/event-stream", headers=headers)
 
-                db.session.add(replay)
-                db.session.commit()
+    subscription = live_updates.subscribe()
+    if not subscription:
+        return flask.Response("Too many live connections", 503, headers={ "Retry-After" : "60" })
 
-                check_replay_trigger(replay)
+    heartbeat = app.config["SSE_HEARTBEAT"]
+    deadline = time.monotonic() + app.config["SSE_MAX_SECONDS"]
 
-            except ValueError as e:
-                results.append((fname, str(e)))
-                continue
-            except pygbx.GbxLoadError as e:
-                print(f"Failed to load Replay: {e}")
-                continue
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not subscription.closed and time.monotonic() < deadline:
+                event = subscription.get(timeout=heartbeat)
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "event: record\ndata: {}\n\n".format(json.dumps(event))
+        finally:
+            live_updates.unsubscribe(subscription)
+
+    # the generator's finally never runs if the response is closed before it starts #
+    r = flask.Response(stream(), mimetype="text/event-stream", headers=headers)
+    r.call_on_close(lambda: live_updates.unsubscribe(subscription))
+    return r
+
+def _release_stored(items):
+    '''Clean up the stored files of items whose replay was not inserted'''
+
+    if not items:
+        return
+
+    hashes = [item.filehash for item in items]
+    query = db.session.query(ParsedReplay.filehash).filter(ParsedReplay.filehash.in_(hashes))
+    known = set(filehash for (filehash,) in query)
+
+    for item in items:
+
+        if item.filehash not in known:
+            path = replay_store.locate(item.filehash)
+            if path:
+                os.remove(path)
 
+        # a duplicate stored the file again, the owner's upload to S3 may be done already #
+        elif s3_enabled():
+            job_queue.enqueue("s3_upload", filehash=item.filehash,
+                                path=replay_store.path(item.filehash))
+
+    db.session.commit()
+
+def _commit_uploads(items):
+    '''Insert all parsed replays of a batch in a single transaction'''
+
+    staged = [item for item in items if item.ghost]
+    if not staged:
+        return []
+
+    for item in staged:
+        item.replay = replay_from_ghost(item.ghost)
+        _store_upload(item)
+
+    try:
+        _insert_replays([item.replay for item in staged])
+        db.session.commit()
+    except sqlalchemy.exc.IntegrityError:
+
+        # concurrent upload of the same file, find it with one transaction per replay #
+        db.session.rollback()
+        for item in staged:
+            try:
+                _insert_replays([item.replay])
+                db.session.commit()
             except sqlalchemy.exc.IntegrityError as e:
-                results.append((fname, str(e.args)))
                 db.session.rollback()
-                continue
+                item.error = str(e.args)
+                item.replay = None
+    except Exception:
+        db.session.rollback()
+        _release_stored([item for item in staged])
+        raise
 
-            results.append((fname, None))
+    _release_stored([item for item in staged if not item.replay])
 
+    on_replays_committed(set(item.replay.map_uid for item in staged if item.replay))
+    job_queue.wakeup()
+    return [item.replay for item in staged if item.replay]
+
+@app.route("/upload", methods=['GET', 'POST'])
+def upload():
+
+    uploader = flask.request.headers.get(app.config["AUTH_HEADER"])
+
+    if flask.request.method == 'POST':
+
+        f_list = flask.request.files.getlist("file[]")
+
+        items = [_stage_upload(f_storage) for f_storage in f_list]
+
+        try:
+            if items:
+                _reject_known_uploads(items)
+                _parse_uploads(items, uploader)
+                _commit_uploads(items)
+        finally:
+            for item in items:
+                if os.path.exists(item.tmp_path):
+                    os.remove(item.tmp_path)
+
+        results = [(item.fname, item.error) for item in items]
         return flask.render_template("upload-post.html", results=results)
 
     else:
         return flask.render_template("upload.html")
 
 def check_replay_trigger(replay):
+    '''Record an event for the next notification digest if <replay> is a new record'''
 
-    map_obj = db.session.query(Map).filter(Map.map_uid == replay.map_uid).first()
-    best = map_obj.get_best_replay()
-    second = map_obj.get_second_best_replay()
-
-    if not second:
+    if not app.config.get("DISPATCH_SERVER"):
         return
 
-    if replay.filehash != best.filehash:
+    entry = db.session.get(MapLeaderboard, replay.map_uid)
+    if not entry or entry.best_filehash != replay.filehash or not entry.second_filehash:
         return
 
+    second = db.session.get(ParsedReplay, entry.second_filehash)
     if second.uploader == replay.uploader:
         return
 
-    settings = db.session.query(UserSettings).filter(UserSettings.user == second.uploader).first()
-    if settings and settings.notifications_self:
-        notifications.send_notification(app, settings.user, map_obj.map_uid, second, replay)
+    db.session.add(RecordEvent(map_uid=entry.map_uid, old_filehash=second.filehash,
+                        new_filehash=replay.filehash, created=datetime.datetime.now()))
+    schedule_notify_digest()
+
+def schedule_notify_digest():
+    '''Queue a digest NOTIFY_WINDOW seconds from now unless one is already waiting'''
+
+    pending = db.session.query(Job.id).filter(Job.kind == "notify_digest",
+                                                Job.status == "queued").first()
+    if pending:
+        return
+
+    run_after = datetime.datetime.now() + datetime.timedelta(seconds=app.config["NOTIFY_WINDOW"])
+    job_queue.enqueue("notify_digest", run_after=run_after)
+
+def collect_digests(events, replays):
+    '''Group record events by recipient, recipients of the same events share one message
+
+    The displaced player is notified if they want notifications about themselves,
+    notifications_all subscribers about every record except their own.
+    '''
+
+    query = db.session.query(UserSettings.user).filter(UserSettings.notifications_all.is_(True))
+    subscribers = set(user for (user,) in query)
+
+    per_user = collections.defaultdict(list)
+    for event in events:
+
+        old, new = replays[event.old_filehash], replays[event.new_filehash]
+        recipients = subscribers - { new.uploader }
+
+        settings = get_user_settings(old.uploader) if old.uploader else None
+        if settings and settings["notifications_self"]:
+            recipients.add(old.uploader)
+
+        for user in recipients:
+            per_user[user].append(event)
+
+    groups = collections.defaultdict(list)
+    for user, user_events in per_user.items():
+        groups[tuple(e.id for e in user_events)].append(user)
+
+    return [ (users, [ e for e in events if e.id in set(ids) ]) for ids, users in groups.items() ]
+
+@job_queue.handler("s3_upload")
+def s3_upload_job(filehash, path):
+
+    # fsck may have moved the file into its shard since, or queued it twice #
+    path = replay_store.locate(filehash) or path
+    if not os.path.isfile(path):
+        print("{} already uploaded to S3".format(filehash), file=sys.stderr)
+        return
+
+    replay = db.session.get(ParsedReplay, filehash)
+    upload_to_s3(path, replay)
+    os.remove(path)
+
+@job_queue.handler("notify_digest")
+def notify_digest_job():
+    '''Turn all pending record events into one dispatch job per message and recipient batch'''
+
+    # claim the pending events atomically, a concurrent digest job only gets the rest #
+    claim = sqlalchemy.update(RecordEvent).where(RecordEvent.dispatched.is_(None))
+    claim = claim.values(dispatched=datetime.datetime.now()).returning(RecordEvent.id)
+    claimed = db.session.execute(claim).scalars().all()
+    if not claimed:
+        return
+
+    events = db.session.query(RecordEvent).filter(RecordEvent.id.in_(claimed))
+    events = events.order_by(asc(RecordEvent.id)).all()
+
+    hashes = set(e.old_filehash for e in events) | set(e.new_filehash for e in events)
+    query = db.session.query(ParsedReplay).filter(ParsedReplay.filehash.in_(hashes))
+    replays = dict((r.filehash, r) for r in query)
+
+    for users, user_events in collect_digests(events, replays):
+        records = [ (e.map_uid, replays[e.old_filehash], replays[e.new_filehash])
+                        for e in user_events ]
+        message = notifications.build_message(records)
+        for batch in notifications.batches(users):
+            job_queue.enqueue("dispatch", users=batch, message=message)
+
+    job_queue.wakeup()
+
+@job_queue.pruner
+def prune_record_events(cutoff):
+    '''Delete record events dispatched before <cutoff>, runs when finished jobs are pruned'''
+
+    query = db.session.query(RecordEvent).filter(RecordEvent.dispatched < cutoff)
+    deleted = query.delete(synchronize_session=False)
+    if deleted:
+        print("Pruned {} dispatched record events".format(deleted), file=sys.stderr)
+
+@job_queue.handler("dispatch")
+def dispatch_job(users, message):
+    notifications.dispatch(app, users, message)
+
+@job_queue.handler("notify")
+def notify_job(target_user, map_uid, old_filehash, new_filehash):
+    '''Jobs queued before digests existed are folded into the next digest'''
+
+    db.session.add(RecordEvent(map_uid=map_uid, old_filehash=old_filehash,
+                        new_filehash=new_filehash, created=datetime.datetime.now()))
+    schedule_notify_digest()
+
+@app.route("/jobs")
+def jobs():
+
+    counts = job_queue.status_counts()
+    recent = db.session.query(Job).order_by(desc(Job.updated)).limit(50).all()
+    return flask.render_template("jobs.html", counts=counts, jobs=recent)
+
+REPLAY_CACHE_DIR = os.environ.get("REPLAY_CACHE_DIR") or "cache"
+REPLAY_CACHE_MAX_BYTES = int(os.environ.get("REPLAY_CACHE_MAX_BYTES") or 1024 * 1024 * 1024)
+replay_cache = None
+
+@app.route("/s3-stats")
+def s3_stats():
+    return flask.jsonify(s3storage.stats.as_dict())
+
+CACHE_HITS = metrics.Gauge("tm_cache_hits", "Cache hits", ("cache",))
+CACHE_MISSES = metrics.Gauge("tm_cache_misses", "Cache misses", ("cache",))
+REPLAY_CACHE_BYTES = metrics.Gauge("tm_replay_cache_bytes", "Size of the local replay cache")
+JOBS = metrics.Gauge("tm_jobs", "Background jobs by status", ("status",))
+SSE_CLIENTS = metrics.Gauge("tm_sse_clients", "Connected live update streams")
+
+@app.route("/metrics")
+def prometheus_metrics():
+    '''All metrics in the Prometheus text format, cache & job statistics are read on scrape'''
+
+    responses = response_cache.stats()
+    CACHE_HITS.set("responses", value=responses["hits"])
+    CACHE_MISSES.set("responses", value=responses["misses"])
+
+    if replay_cache:
+        replays = replay_cache.stats()
+        CACHE_HITS.set("replays", value=replays["hits"])
+        CACHE_MISSES.set("replays", value=replays["misses"])
+        REPLAY_CACHE_BYTES.set(value=replays["bytes"])
+
+    for status, count in job_queue.status_counts().items():
+        JOBS.set(status, value=count)
+
+    SSE_CLIENTS.set(value=live_updates.stats()["subscribers"])
+
+    return flask.Response(metrics.render(), 200, mimetype="text/plain; version=0.0.4")
+
+@app.route("/cache-stats")
+def cache_stats():
+    return flask.jsonify({
+        "replays" : replay_cache.stats() if replay_cache else {},
+        "responses" : response_cache.stats(),
+        "events" : live_updates.stats(),
+    })
+
+# replays are content-addressed by their hash and never change #
+DOWNLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_WAIT_SECONDS = 10
+
+def _send_replay_file(path, filename):
+
+    r = flask.send_file(path, mimetype="application/octet-stream", conditional=True,
+                            etag=filename)
+    r.headers["Cache-Control"] = DOWNLOAD_CACHE_CONTROL
+    return r
+
+def _stream_s3_body(body, writer):
+    '''Yield an S3 body in chunks, optionally teeing it into the replay cache'''
+
+    completed = False
+    try:
+        for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+            if writer:
+                writer.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        body.close()
+        if writer and completed:
+            writer.commit()
+        elif writer:
+            writer.abort()
 
 @app.route("/downloads/<path:filename>")
 def downloads(filename):
 
-    # Ensure directory exists
-    os.makedirs("uploads", exist_ok=True)
-    local_path = os.path.join("uploads/", filename)
+    local_path = replay_store.locate(filename)
 
-    if not os.path.isfile(local_path):
-        print(f"{local_path} missing, attempting to retrieve from S3")
-        s3 = get_s3_client()
+    # replays not yet moved to S3 or S3 disabled #
+    if local_path:
+        print(f"Sending {filename}")
+        return _send_replay_file(local_path, filename)
 
+    if not replay_cache or werkzeug.utils.secure_filename(filename) != filename:
+        abort(404)
+
+    # the filehash is a strong etag, a client that has it has the correct content #
+    if flask.request.if_none_match.contains(filename):
+        r = flask.Response(status=304)
+        r.set_etag(filename)
+        r.headers["Cache-Control"] = DOWNLOAD_CACHE_CONTROL
+        return r
+
+    # concurrent requests wait for the one already streaming the replay into the cache #
+    cached_path = replay_cache.lookup(filename)
+    if not cached_path and flask.request.method != "HEAD":
+        cached_path = replay_cache.wait(filename, DOWNLOAD_WAIT_SECONDS)
+    if cached_path:
         try:
-            s3.download_file(
-                S3_BUCKET,
-                f"{filename}",
-                os.path.join("uploads/", filename)
-            )
-
-        except Exception:
-            print(f"{filename} not found on S3")
+            return _send_replay_file(cached_path, filename)
+        except FileNotFoundError:
+            print(f"{filename} evicted while sending, falling back to S3")
+
+    headers = {
+        "Accept-Ranges" : "bytes",
+        "Cache-Control" : DOWNLOAD_CACHE_CONTROL,
+    }
+
+    # headers only, nothing is fetched or cached #
+    if flask.request.method == "HEAD":
+        size = s3storage.head_object(filename)
+        if size is None:
             abort(404)
+        headers["Content-Length"] = str(size)
+        r = flask.Response(status=200, headers=headers, mimetype="application/octet-stream")
+        r.set_etag(filename)
+        return r
+
+    # stream from S3, only full downloads are written to the cache #
+    byte_range = flask.request.headers.get("Range")
+    try:
+        obj = s3storage.get_object(f"{filename}", byte_range=byte_range)
+    except botocore.exceptions.ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code == "InvalidRange":
+            abort(416)
+        print(f"{filename} not found on S3 ({code})")
+        abort(404)
+
+    writer = None if byte_range else replay_cache.tee(filename)
+    headers["Content-Length"] = str(obj["ContentLength"])
+
+    status = 200
+    if obj.get("ContentRange"):
+        status = 206
+        headers["Content-Range"] = obj["ContentRange"]
+
+    print(f"Streaming {filename} from S3")
+    r = flask.Response(_stream_s3_body(obj["Body"], writer), status=status, headers=headers,
+                        mimetype="application/octet-stream", direct_passthrough=True)
+    r.set_etag(filename)
 
-    print(f"Sending {filename}")
-    return send_from_directory("uploads/", filename)
+    # the generator's cleanup only runs if it was started, e.g. not if the client left early #
+    def release():
+        obj["Body"].close()
+        if writer:
+            writer.abort()
 
-def create_app():
+    r.call_on_close(release)
+    return r
 
+def _reindex_filename(replay):
+    '''Original upload filename, tmnf replays derive their map from it'''
+
+    if replay.game == "tmnf":
+        return "replay_{}.Replay.gbx".format(replay.map_uid)
+    return "{}.Replay.gbx".format(replay.filehash)
+
+def _fetch_for_reindex(replay, tmp_dir):
+    '''Local path of a stored replay, downloaded from S3 if necessary (None if missing)'''
+
+    for path in (replay.filepath, replay_store.locate(replay.filehash)):
+        if path and os.path.isfile(path):
+            return path
+
+    if not s3_enabled():
+        return None
+
+    path = os.path.join(tmp_dir, replay.filehash)
+    try:
+        s3storage.download_file(replay.filehash, path)
+    except botocore.exceptions.ClientError as e:
+        print("Cannot fetch {} from S3: {}".format(replay.filehash, e), file=sys.stderr)
+        return None
+
+    return path
+
+REINDEX_FETCH_WORKERS = 8
+
+def reindex(batch_size=200, full=False):
+    '''Re-parse all stored replays not parsed by the current parser version yet
+
+    Progress is committed per batch, an interrupted run continues where it stopped.
+    '''
+
+    version = tm2020parser.PARSER_VERSION
+    if full:
+        db.session.query(ParseResult).filter(ParseResult.parser_version == version).delete()
+        db.session.commit()
+
+    cached = sqlalchemy.orm.aliased(ParseResult)
+    pending = db.session.query(ParsedReplay).outerjoin(cached, and_(
+                    cached.filehash == ParsedReplay.filehash, cached.parser_version == version))
+    pending = pending.filter(cached.filehash.is_(None)).order_by(asc(ParsedReplay.filehash))
+
+    total = pending.count()
+    print("Reindexing {} replays with parser version {}".format(total, version))
+
+    done = changed = failed = missing = 0
+    changed_maps = set()
+    last = None
+
+    fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=REINDEX_FETCH_WORKERS)
+    os.makedirs(replay_store.directory, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=replay_store.directory, prefix=".reindex-")
+
+    try:
+        while True:
+
+            # keyset iteration, rows of finished batches leave the pending set anyway #
+            query = pending
+            if last:
+                query = query.filter(ParsedReplay.filehash > last)
+            replays = query.limit(batch_size).all()
+            if not replays:
+                break
+            last = replays[-1].filehash
+
+            paths = list(fetch_pool.map(lambda r: _fetch_for_reindex(r, tmp_dir), replays))
+            found = [(r, p) for r, p in zip(replays, paths) if p]
+            missing += len(replays) - len(found)
+
+            args = [(p, _reindex_filename(r), r.uploader, r.filehash) for r, p in found]
+            results = None
+            if len(args) >= PARSE_POOL_MIN_FILES and app.config["PARSE_WORKERS"] > 1:
+                try:
+                    results = list(get_parse_pool().map(tm2020parser.try_parse_replay_file,
+                                                            *zip(*args)))
+                except concurrent.futures.process.BrokenProcessPool:
+                    print("Parse pool broken, parsing in main process", file=sys.stderr)
+                    _reset_parse_pool()
+                except Exception as e:
+                    # e.g. a result that cannot be sent back, the batch must not abort the run #
+                    print("Parse pool failed ({}), parsing in main process".format(
+                                type(e).__name__), file=sys.stderr)
+
+            if results is None:
+                results = [tm2020parser.try_parse_replay_file(*a) for a in args]
+
+            updates = []
+            for (replay, path), (ghost, error) in zip(found, results):
+
+                if path.startswith(tmp_dir):
+                    os.remove(path)
+
+                db.session.add(parse_result_from(ghost, replay.filehash, error))
+                if error:
+                    failed += 1
+                    print("Cannot parse {}: {}".format(replay.filehash, error), file=sys.stderr)
+                    continue
+
+                diff = dict((field, getattr(ghost, field)) for field in REINDEX_FIELDS
+                                if getattr(ghost, field) != getattr(replay, field))
+                if not diff:
+                    continue
+
+                diff.update({ "filehash" : replay.filehash })
+                updates.append(diff)
+                changed_maps.update((replay.map_uid, ghost.map_uid))
+
+                if ghost.map_uid != replay.map_uid:
+                    db.session.merge(map_from_replay(ghost))
+
+            # bulk update by primary key #
+            if updates:
+                db.session.execute(sqlalchemy.update(ParsedReplay), updates)
+                changed += len(updates)
+
+            db.session.commit()
+            done += len(replays)
+            print("Reindexed {}/{} ({} changed, {} failed, {} missing)".format(
+                        done, total, changed, failed, missing))
+
+    finally:
+        fetch_pool.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if changed:
+
+        # maps whose replays all moved to another map #
+        orphans = db.session.query(Map).filter(~Map.map_uid.in_(
+                        db.session.query(ParsedReplay.map_uid).distinct()))
+        for m in orphans:
+            db.session.delete(m)
+        db.session.commit()
+
+        rebuild_leaderboard()
+        on_replays_committed(changed_maps)
+        print("Restart running servers to drop their caches")
+
+FSCK_WORKERS = 8
+
+class FsckResult():
+    '''Storage state of one replay row'''
+
+    def __init__(self, filehash, filepath):
+        self.filehash = filehash
+        self.filepath = filepath
+        self.path = None
+        self.s3 = None
+        self.corrupt = False
+
+def _fsck_replay(result, verify):
+    '''Locate a replay on disk (and S3), optionally verifying its content hash'''
+
+    if result.filepath and os.path.isfile(result.filepath):
+        result.path = result.filepath
+    else:
+        result.path = replay_store.locate(result.filehash)
+
+    if result.path and verify:
+        result.corrupt = replaystore.file_hash(result.path) != result.filehash
+
+    if s3_enabled():
+        result.s3 = s3storage.head_object(result.filehash) is not None
+
+    return result
+
+def fsck(verify=False, repair=False, batch_size=1000, gc_age=3600):
+    '''Cross-check all replay rows against the upload directory and S3
+
+    Reports replays stored nowhere, corrupt files, files still in the flat layout,
+    stale filepaths and files without a row. With <repair> flat files are moved into
+    their shard, filepaths are corrected and local-only replays are queued for S3.
+    Returns the number of problems that were not repaired.
+    '''
+
+    counts = collections.Counter()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=FSCK_WORKERS)
+    query = db.session.query(ParsedReplay.filehash, ParsedReplay.filepath)
+    last = None
+
+    try:
+        while True:
+
+            batch = query
+            if last:
+                batch = batch.filter(ParsedReplay.filehash > last)
+            rows = batch.order_by(asc(ParsedReplay.filehash)).limit(batch_size).all()
+            if not rows:
+                break
+            last = rows[-1].filehash
+
+            results = pool.map(lambda r: _fsck_replay(FsckResult(*r), verify), rows)
+            for result in results:
+
+                counts["replays"] += 1
+                if not result.path and not result.s3:
+                    counts["missing"] += 1
+                    print("Missing: {}".format(result.filehash), file=sys.stderr)
+                    continue
+
+                if result.corrupt:
+                    counts["corrupt"] += 1
+                    print("Corrupt: {}".format(result.path), file=sys.stderr)
+                    continue
+
+                if not result.path:
+                    continue
+
+                if result.path == replay_store.legacy_path(result.filehash):
+                    counts["flat"] += 1
+                    if repair:
+                        result.path = replay_store.relocate(result.filehash)
+                        counts["repaired"] += 1
+
+                if result.path != result.filepath:
+                    counts["stale filepath"] += 1
+                    if repair:
+                        db.session.query(ParsedReplay).filter(
+                                ParsedReplay.filehash == result.filehash).update(
+                                    { "filepath" : result.path })
+                        counts["repaired"] += 1
+
+                if result.s3 is False:
+                    counts["not on S3"] += 1
+                    if repair:
+                        job_queue.enqueue("s3_upload", filehash=result.filehash,
+                                            path=result.path)
+                        counts["repaired"] += 1
+
+            db.session.commit()
+            print("Checked {} replays".format(counts["replays"]))
+
+        # files without a row, e.g. from uploads that failed after their file was stored #
+        stored = replay_store.walk()
+        while True:
+
+            files = dict(itertools.islice(stored, batch_size))
+            if not files:
+                break
+
+            known = db.session.query(ParsedReplay.filehash).filter(
+                            ParsedReplay.filehash.in_(list(files)))
+            for filehash in set(files) - set(h for (h,) in known):
+                counts["orphan"] += 1
+                print("Orphan: {}".format(files[filehash]), file=sys.stderr)
+
+    finally:
+        pool.shutdown()
+
+    removed, freed = replay_store.gc(gc_age)
+    print("Removed {} temporary files ({} bytes)".format(removed, freed))
+
+    for name in ("replays", "missing", "corrupt", "flat", "stale filepath", "not on S3",
+                    "orphan", "repaired"):
+        print("{:<16} {}".format(name, counts[name]))
+
+    # flat layout & pending S3 uploads are not errors, the server handles them #
+    problems = counts["missing"] + counts["corrupt"] + counts["orphan"]
+    if not repair:
+        problems += counts["stale filepath"]
+    return problems
+
+def migrate_timestamp_column(table, column):
+    '''Convert a column holding ISO datetime strings to a timestamp column in place'''
+
+    preparer = db.engine.dialect.identifier_preparer
+    name = preparer.format_column(column)
+
+    if db.engine.dialect.name == "postgresql":
+        print("Converting {}.{} to timestamp".format(table.name, column.name))
+        ddl = "ALTER TABLE {table} ALTER COLUMN {col} TYPE TIMESTAMP USING NULLIF({col}, '')::timestamp"
+        with db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(ddl.format(table=preparer.format_table(table), col=name)))
+
+    elif db.engine.dialect.name == "sqlite":
+
+        # sqlite keeps the declared type, but values must use the stored datetime format #
+        # ('YYYY-MM-DD HH:MM:SS') to compare correctly with values written from now on   #
+        where = "FROM {table} WHERE {col} LIKE '%T%'".format(
+                        table=preparer.format_table(table), col=name)
+
+        # runs at every startup, only write (and lock) the table if there is anything to do #
+        with db.engine.connect() as conn:
+            pending = conn.execute(sqlalchemy.text("SELECT 1 " + where + " LIMIT 1")).first()
+        if not pending:
+            return
+
+        update = "UPDATE {table} SET {col} = replace({col}, 'T', ' ') WHERE {col} LIKE '%T%'"
+        with db.engine.begin() as conn:
+            result = conn.execute(sqlalchemy.text(update.format(
+                                        table=preparer.format_table(table), col=name)))
+            if result.rowcount:
+                print("Normalized {} timestamps in {}.{}".format(result.rowcount, table.name,
+                                                                    column.name))
+    else:
+        print("Cannot convert {}.{} to timestamp on {}".format(table.name, column.name,
+                    db.engine.dialect.name), file=sys.stderr)
+
+# tables of removed models, their content was derived from the replays #
+DROPPED_TABLES = ("personal_bests",)
+
+def migrate_schema():
+    '''Add columns and indexes declared on the models but missing in an existing database'''
+
+    inspector = sqlalchemy.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+
+    for name in DROPPED_TABLES:
+        if inspector.has_table(name):
+            print("Dropping unused table {}".format(name))
+            with db.engine.begin() as conn:
+                conn.execute(sqlalchemy.text("DROP TABLE {}".format(preparer.quote(name))))
+
+    for table in db.metadata.sorted_tables:
+
+        existing = dict((c["name"], c["type"]) for c in inspector.get_columns(table.name))
+        for column in table.columns:
+
+            # upload timestamps used to be stored as strings #
+            if column.name in existing and isinstance(column.type, DateTime) and \
+                                        not isinstance(existing[column.name], DateTime):
+                migrate_timestamp_column(table, column)
+
+            if column.name not in existing:
+                print("Adding missing column {} to {}".format(column.name, table.name))
+                ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(preparer.format_table(table),
+                            preparer.format_column(column),
+                            column.type.compile(dialect=db.engine.dialect))
+                with db.engine.begin() as conn:
+                    conn.execute(sqlalchemy.text(ddl))
+
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            # indexes limited to another dialect with ddl_if() are never created #
+            if index._ddl_if and index._ddl_if.dialect not in (None, db.engine.dialect.name):
+                continue
+
+            if index.name not in existing:
+                print("Creating missing index {} on {}".format(index.name, table.name))
+                index.create(db.engine)
+
+def migrate_campaigns():
+    '''Fill the campaign columns of maps added before they existed'''
+
+    maps = db.session.query(Map).filter(Map.listed.is_(None)).all()
+    for m in maps:
+        m.set_campaign()
+
+    if maps:
+        db.session.commit()
+        print("Parsed campaign of {} maps".format(len(maps)))
+
+def migrate_cp_times(batch_size=1000):
+    '''Convert legacy comma-joined checkpoint times to packed cp_splits'''
+
+    query = db.session.query(ParsedReplay).filter(ParsedReplay.cp_splits.is_(None),
+                                                    ParsedReplay.cp_times.isnot(None))
+    converted = 0
+    while True:
+
+        replays = query.limit(batch_size).all()
+        if not replays:
+            break
+
+        for replay in replays:
+            try:
+                cp_times = [ int(t) for t in replay.cp_times.split(",") if t ]
+            except ValueError:
+                print("Dropping unreadable checkpoint times of {}".format(replay.filehash),
+                        file=sys.stderr)
+                cp_times = None
+            replay.cp_splits = cpanalytics.pack_cp_times(cp_times) or b""
+            replay.cp_times = None
+
+        db.session.commit()
+        converted += len(replays)
+
+    if converted:
+        print("Converted checkpoint times of {} replays".format(converted))
+
+def create_app(start_jobs=True):
+
+    metrics.instrument_engine(db.engine)
     db.create_all()
+    migrate_schema()
+    migrate_cp_times()
+    migrate_campaigns()
+
+    # errors of dispatch jobs used to include the dispatcher URL with its access token #
+    leaked = db.session.query(Job).filter(Job.last_error.like("%dispatch-access-token%"))
+    if leaked.update({ "last_error" : "DispatchError (message removed)" },
+                        synchronize_session=False):
+        db.session.commit()
+
+    # backfill leaderboard for databases created before it (or its summary) existed #
+    if db.session.query(ParsedReplay).first():
+        query = db.session.query(MapLeaderboard)
+        if not query.first() or query.filter(MapLeaderboard.replay_count.is_(None)).first():
+            rebuild_leaderboard()
 
     print(f"S3 enabled: {s3_enabled()} (if true will only write tmp/cache to disk")
     app.config["DISPATCH_SERVER"] = os.environ.get("DISPATCH_SERVER")
     if app.config["DISPATCH_SERVER"]:
         app.config["DISPATCH_TOKEN"] = os.environ["DISPATCH_TOKEN"]
 
+    # temporary files of uploads interrupted by a crash or restart #
+    removed, freed = replay_store.gc()
+    if removed:
+        print("Removed {} stale temporary files ({} bytes)".format(removed, freed))
+
+    global replay_cache
+    if s3_enabled() and not replay_cache:
+        replay_cache = replaycache.ReplayCache(REPLAY_CACHE_DIR, REPLAY_CACHE_MAX_BYTES)
+
+    if start_jobs:
+        job_queue.start()
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='TM Replay Server',
                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # general parameters #
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "reindex", "fsck", "gc"],
+                            help="Run the server, re-parse all stored replays, check storage "
+                                    "or remove stale temporary files")
     parser.add_argument("-i", "--interface", default="127.0.0.1", help="Interface to listen on")
     parser.add_argument("-p", "--port",      default="5000",      help="Port to listen on")
+
+    # reindex parameters #
+    parser.add_argument("--batch-size", type=int, default=200, help="Replays per reindex batch")
+    parser.add_argument("--full", action="store_true",
+                            help="Re-parse replays already parsed by the current parser version")
+
+    # fsck/gc parameters #
+    parser.add_argument("--verify", action="store_true",
+                            help="Verify the content hash of every local replay")
+    parser.add_argument("--repair", action="store_true",
+                            help="Move flat files into shards, fix filepaths, queue S3 uploads")
+    parser.add_argument("--gc-age", type=int, default=3600,
+                            help="Seconds after which temporary files are considered stale")
     args = parser.parse_args()
 
+    if args.command == "fsck":
+        with app.app_context():
+            create_app(start_jobs=False)
+            problems = fsck(verify=args.verify, repair=args.repair, gc_age=args.gc_age)
+        sys.exit(1 if problems else 0)
+
+    if args.command == "gc":
+        removed, freed = replay_store.gc(args.gc_age)
+        print("Removed {} temporary files ({} bytes)".format(removed, freed))
+        sys.exit(0)
+
+    if args.command == "reindex":
+        with app.app_context():
+            create_app(start_jobs=False)
+            reindex(batch_size=args.batch_size, full=args.full)
+        sys.exit(0)
+
     # startup #
     with app.app_context():
         create_app()
@@ -0,0 +1,83 @@
+/* live record updates for the index, only the rows of changed maps are reloaded */
+const index_rows = document.getElementById("index-rows")
+
+/* map_uids changed since the last row refresh */
+var live_pending = new Set()
+var live_timer = null
+var live_source = null
+
+/* defer */
+live_connect()
+
+function live_connect(){
+
+    live_source = new EventSource("/events")
+
+    live_source.addEventListener("record", e => {
+        live_pending.add(JSON.parse(e.data).map_uid)
+        if(!live_timer){
+            /* several uploads usually arrive together */
+            live_timer = setTimeout(live_flush, 500)
+        }
+    })
+
+    /* events may have been missed while disconnected */
+    var connected_before = false
+    live_source.addEventListener("open", e => {
+        if(connected_before){
+            refresh_index_rows()
+        }
+        connected_before = true
+    })
+
+    /* the browser reconnects by itself unless the server refused the stream (e.g. too */
+    /* many live connections), then poll the rows until a stream is accepted again      */
+    live_source.addEventListener("error", e => {
+        if(live_source.readyState == EventSource.CLOSED){
+            setTimeout(() => {
+                refresh_index_rows()
+                live_connect()
+            }, 30000)
+        }
+    })
+}
+
+function live_flush(){
+
+    const map_uids = Array.from(live_pending)
+    live_pending.clear()
+    live_timer = null
+
+    const params = new URLSearchParams(window.location.search)
+    map_uids.forEach(map_uid => params.append("map_uid", map_uid))
+
+    fetch("/index-rows?" + params, { credentials: "include" }).then(response => {
+        response.text().then(html => {
+
+            const template = document.createElement("template")
+            template.innerHTML = "<table><tbody>" + html + "</tbody></table>"
+
+            template.content.querySelectorAll("tr[data-map-uid]").forEach(row => {
+                const old = index_rows.querySelector(
+                                "tr[data-map-uid=\"" + CSS.escape(row.dataset.mapUid) + "\"]")
+                if(old){
+                    old.replaceWith(row)
+                }else{
+                    /* new map, keep the server's ordering */
+                    refresh_index_rows()
+                }
+            })
+        })
+    })
+}
+
+/* reload all rows, e.g. after the settings changed */
+function refresh_index_rows(){
+
+    const params = new URLSearchParams(window.location.search)
+    return fetch("/index-rows?" + params, { credentials: "include" }).then(response => {
+        response.text().then(html => {
+            index_rows.innerHTML = html
+        })
+    })
+}
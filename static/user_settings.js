@@ -7,20 +7,17 @@ var sliders_set = false
 /* defer */
 sliders_load_all()
 
-/* get initial values & set listeners */
+/* get initial values (all settings in one request) & set listeners */
 function sliders_load_all(){
-    Promise.all(sliders.map(s => {
-        fetch("/update-user-settings?key=" + s.id, { credentials: "include" }).then(response => {
-            response.text().then(data => {
-                if(data == "True"){
-                    s.checked = true
-                }
+    fetch("/update-user-settings", { credentials: "include" }).then(response => {
+        response.json().then(settings => {
+            sliders.forEach(s => {
+                s.checked = settings[s.id] === true
+                s.addEventListener("change", submit)
             })
+            sliders_set = true
         })
-        s.addEventListener("change", submit)
-    })).then(
-        sliders_set = true
-    )
+    })
 }
 
 /* submit settings */
@@ -41,7 +38,12 @@ function submit(e){
             }
     ).then(response => {
         if(s.id.startsWith("show")){
-            window.location.reload()
+            /* only the table depends on the settings */
+            if(typeof refresh_index_rows === "function"){
+                refresh_index_rows()
+            }else{
+                window.location.reload()
+            }
         }
     })
 }
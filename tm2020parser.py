@@ -1,48 +1,75 @@
 import re
 import os
+import time
+import mmap
 import datetime
 import hashlib
 import pygbx
 import xmltodict
+import cpanalytics
 
-def get_latest_season_from_maps(maps):
-    '''Determine the latest season in DB'''
+# increment whenever the values derived from a replay change, so reindex re-parses all files #
+PARSER_VERSION = 1
 
-    order = ["Winter", "Spring", "Summer", "Fall"]
+SEASON_ORDERING = ["Winter", "Spring", "Summer", "Fall"]
+CAMPAIGN_PATTERN = re.compile(r"^({}) (\d{{4}}) - (\d+)$".format("|".join(SEASON_ORDERING)))
 
-    max_year = 0
-    max_season = "Winter"
+def parse_campaign(mapname):
+    '''Split an official campaign mapname like 'Fall 2024 - 07' into (season, year, position)
 
-    if not maps:
-        return
+    Returns None for maps which are not part of a seasonal campaign.
+    '''
 
-    for m in maps:
-        splitted = m.map_uid.split(" ")
+    match = CAMPAIGN_PATTERN.match(mapname)
+    if not match:
+        return None
 
-        # not a campain map #
-        if len(splitted) < 3:
-            return
+    season, year, position = match.groups()
+    return season, int(year), int(position)
 
-        season = splitted[0]
-        year = splitted[1]
+def season_order(season, year):
+    '''Monotonic number of a season, the latest season has the highest number'''
+    return year * len(SEASON_ORDERING) + SEASON_ORDERING.index(season)
 
-        # also not a campaing map #
-        if not season in order:
-            return
-        try:
-            year = int(year)
-        except ValueError:
-            return
+READ_CHUNK_SIZE = 64 * 1024
+
+def stream_to_file(stream, target, chunk_size=READ_CHUNK_SIZE):
+    '''Copy a stream into an open file in chunks, return the SHA-512 of the content'''
+
+    f_hash = hashlib.sha512()
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        f_hash.update(chunk)
+        target.write(chunk)
+
+    return f_hash.hexdigest()
+
+def null_separated(content, limit):
+    '''Yield up to <limit> non-empty, zero-copy views of null-separated fields'''
+
+    view = memoryview(content)
+    start = 0
+    count = 0
+
+    while count < limit and start < len(content):
 
-        if year > max_year or year == max_year and order.index(season) >= order.index(max_season):
-            max_year = year
-            max_season = season
+        end = content.find(b"\0", start)
+        if end == -1:
+            end = len(content)
 
-    return "{} {}".format(max_season, max_year)
+        if end > start:
+            yield view[start:end]
+            count += 1
+
+        start = end + 1
 
 class GhostWrapper():
 
-    def __init__(self, fullpath, uploader):
+    def __init__(self, fullpath, uploader, content=None, filehash=None):
+        '''Parse a replay, content/filehash may be passed if the file was already read'''
 
         # set parameters as attributes #
         self.fullpath = fullpath
@@ -52,8 +79,19 @@ class GhostWrapper():
         if not fullpath.lower().endswith(".gbx"):
             raise ValueError("Path must be a .gbx file")
 
+        # parse time is reported by the caller, this may run in a worker process #
+        start = time.perf_counter()
+
+        # read the file exactly once, everything below works on this buffer #
+        if content is None:
+            with open(fullpath, "rb") as f:
+                content = f.read()
+
+        if filehash is None:
+            filehash = hashlib.sha512(content).hexdigest()
+
         # parse with normal GBX-parser
-        g = pygbx.Gbx(fullpath)
+        g = pygbx.Gbx(content)
         ghost = g.get_class_by_id(pygbx.GbxType.CTN_GHOST)
         if not ghost:
             raise ValueError("No ghost found in GBX file")
@@ -64,23 +102,13 @@ class GhostWrapper():
         else:
             mapname_from_filename = None
 
-        # compute filehash #
-        f_hash = None
-        content = None
-        with open(fullpath, "rb") as f:
-
-            # read file & compute #
-            content = f.read()
-            decoded_string = content.decode("ascii", errors="ignore")
-            f_hash = hashlib.sha512(content).hexdigest()
-
         # general variables #
-        self.filehash = f_hash
+        self.filehash = filehash
         self.ghost_id = ghost.id
         self.login = ghost.login
         self.race_time = ghost.race_time
-        self.cp_times = ",".join(map(str, ghost.cp_times))
-        self.upload_dt = datetime.datetime.now().isoformat()
+        self.cp_splits = cpanalytics.pack_cp_times(ghost.cp_times)
+        self.upload_dt = datetime.datetime.now()
 
         # game version #
         if ghost.game_version.startswith("TmForever"):  
@@ -91,14 +119,16 @@ class GhostWrapper():
             self.login_uid_tm2020 = None
 
             # sanity check mapname for tmnf #
-            if mapname_from_filename not in decoded_string:
+            if content.find(mapname_from_filename.encode("utf-8")) == -1:
                 raise ValueError("Mapname indicated by filename does not match map in file")
 
         else:
 
             # set gameversion and compute from xml #
             self.game = "tm2020"
-            self._set_from_2020()
+            self._set_from_2020(content)
+
+        self.parse_seconds = time.perf_counter() - start
 
 
     def _compute_map_from_filename(self):
@@ -117,43 +147,72 @@ class GhostWrapper():
             raise ValueError("Unexpected filename format. (IndexError)")
         return mapname_from_filename
 
-    def _set_from_2020(self):
+    def _set_from_2020(self, content):
         '''Extract the XML-Header from TM2020-replays to set missing variables'''
 
         # Specify the pattern to match the XML-like string
         pattern = re.compile(rb'<header.*?</header>', re.DOTALL)
-        
-        # Extract XML-like strings from the binary file
-        xml_strings = []
-        with open(self.fullpath, 'rb') as binary_file:
-            binary_data = binary_file.read()
-            matches = re.findall(pattern, binary_data)
-            xml_strings = [match.decode('utf-8') for match in matches]
-        
+
+        # Extract the first XML-like string from the binary content
+        match = re.search(pattern, content)
+        if not match:
+            raise ValueError("No XML header found in TM2020 replay")
+
         # set vars #
-        xml_string = xml_strings[0]
+        xml_string = match.group(0).decode('utf-8')
         xml_dict = xmltodict.parse(xml_string)
-        
+
         self.map_uid = xml_dict["header"]["map"]["@name"]
         print(self.map_uid)
 
-        # load the name #
-        with open(self.fullpath, "rb") as f:
-            content = f.read()
-            result = content.split(b"\0")[:100]
+        # load the name from the first null-separated fields #
+        result = list(null_separated(content, 100))
 
-            # filter out empty bytes #
-            result = list(filter(lambda x: x, result))
+        # release the views in any case, content may be an mmap closed by the caller #
+        try:
 
             # find the uid #
             uid_index = -1
             for i, el in enumerate(result):
-                if self.login in el.decode("ascii", errors="ignore"):
+                if self.login in str(el, "ascii", errors="ignore"):
                     uid_index = i
                     break
 
             if uid_index < 1:
                 raise ValueError("Can't find user UID in replay file.")
-            else:
-                self.login_uid_tm2020 = self.login
-                self.login = result[uid_index-1].strip(b"\x16").decode("utf-8")
+
+            login_field = bytes(result[uid_index-1])
+
+        finally:
+            for el in result:
+                el.release()
+
+        self.login_uid_tm2020 = self.login
+        self.login = login_field.strip(b"\x16").decode("utf-8")
+
+def parse_replay_file(path, name, uploader, filehash=None):
+    '''Parse a stored upload from a read-only mapping, <name> is the original filename'''
+
+    with open(path, "rb") as f:
+
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Uploaded file is empty")
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return GhostWrapper(name, uploader, content=content, filehash=filehash)
+
+def try_parse_replay_file(path, name, uploader, filehash=None):
+    '''Process pool entry point, returns (ghost, None) or (None, error message)'''
+
+    try:
+        return (parse_replay_file(path, name, uploader, filehash), None)
+    except ValueError as e:
+        return (None, str(e))
+    except pygbx.GbxLoadError as e:
+        print(f"Failed to load Replay: {e}")
+        return (None, "Failed to load replay: {}".format(e))
+    except Exception as e:
+
+        # pygbx fails in arbitrary ways on truncated or malformed files, report them per file #
+        print(f"Failed to parse {name}: {type(e).__name__}: {e}")
+        return (None, "Failed to parse replay ({})".format(type(e).__name__))